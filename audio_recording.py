@@ -1,24 +1,21 @@
 import streamlit as st
 import os
-import threading
-import time
-import wave
-import struct
-from pvrecorder import PvRecorder
+import sessions
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 # Set page config
 st.set_page_config(page_title="Real-time Audio Recorder", layout="wide")
 
-# Initialize session state
-if "is_recording" not in st.session_state:
-    st.session_state["is_recording"] = False
-if "audio_frames" not in st.session_state:
-    st.session_state["audio_frames"] = []
-if "thread" not in st.session_state:
-    st.session_state["thread"] = None
+# Initialize session state (only plain values; the recording itself lives in the session manager)
+if "recording_id" not in st.session_state:
+    st.session_state["recording_id"] = None
+if "recording_path" not in st.session_state:
+    st.session_state["recording_path"] = None
 if "recording_status" not in st.session_state:
     st.session_state["recording_status"] = ""
 
+manager = sessions.get_session_manager()
+
 # App title and description
 st.title("Real-time Audio Recorder")
 st.markdown(
@@ -26,53 +23,52 @@ st.markdown(
 )
 
 
-# Recording logic
-def record_audio():
-    recorder = PvRecorder(device_index=-1, frame_length=512)
-    st.session_state["audio_frames"] = []
-
-    try:
-        recorder.start()
-        while st.session_state["is_recording"]:
-            frame = recorder.read()
-            st.session_state["audio_frames"].extend(frame)
-        recorder.stop()
-    finally:
-        recorder.delete()
-
-
-def save_audio():
-    os.makedirs("audio", exist_ok=True)
-    audio = st.session_state["audio_frames"]
-    with wave.open("audio/test.wav", "w") as f:
-        f.setparams((1, 2, 16000, 0, "NONE", "NONE"))
-        f.writeframes(struct.pack("h" * len(audio), *audio))
-    st.session_state["recording_status"] = "Audio saved as `audio/test.wav`."
-
-
 # Layout: Two columns for start/stop buttons
 col1, col2 = st.columns(2)
 
 with col1:
-    if st.button("Start Recording", disabled=st.session_state["is_recording"]):
-        st.session_state["is_recording"] = True
-        st.session_state["recording_status"] = "Recording in progress..."
-        st.session_state["thread"] = threading.Thread(target=record_audio)
-        st.session_state["thread"].start()
+    if st.button(
+        "Start Recording", disabled=st.session_state["recording_id"] is not None
+    ):
+        try:
+            session = manager.start(owner=get_script_run_ctx().session_id)
+            st.session_state["recording_id"] = session.id
+            st.session_state["recording_path"] = session.path
+            st.session_state["recording_status"] = "Recording in progress..."
+        except RuntimeError as e:
+            st.session_state["recording_status"] = str(e)
+        # Redraw so both buttons reflect the new state
+        st.rerun()
 
 with col2:
-    if st.button("Stop Recording", disabled=not st.session_state["is_recording"]):
-        st.session_state["is_recording"] = False
-        st.session_state["thread"].join()
-        save_audio()
+    if st.button("Stop Recording", disabled=st.session_state["recording_id"] is None):
+        session = manager.stop(st.session_state["recording_id"])
+        st.session_state["recording_id"] = None
+        if session and session.error:
+            st.session_state["recording_status"] = f"Recording error: {session.error}"
+        elif session and session.limit_reached:
+            path = st.session_state["recording_path"]
+            st.session_state["recording_status"] = (
+                f"Recording stopped at the {session.max_seconds // 60}-minute limit. "
+                f"Audio saved as `{path}`."
+            )
+        else:
+            path = st.session_state["recording_path"]
+            st.session_state["recording_status"] = f"Audio saved as `{path}`."
+        st.rerun()
 
 # Feedback / status
 if st.session_state["recording_status"]:
     st.info(st.session_state["recording_status"])
 
 # Optionally play audio (if available)
-if os.path.exists("audio/test.wav"):
-    st.audio("audio/test.wav", format="audio/wav")
+recording_path = st.session_state["recording_path"]
+if (
+    recording_path
+    and st.session_state["recording_id"] is None
+    and os.path.exists(recording_path)
+):
+    st.audio(recording_path, format="audio/wav")
 
 # Footer
 st.markdown("---")
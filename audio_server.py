@@ -0,0 +1,217 @@
+import contextvars
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import streamlit as st
+
+# Where the audio endpoint listens, next to Streamlit's default 8501. The
+# browser fetches audio from it directly, so behind a proxy, over https or on
+# a remote host set APHASIANET_AUDIO_URL to the address the browser sees.
+# Without it, remote browsers get whole clips through st.audio instead.
+HOST = os.getenv("APHASIANET_AUDIO_HOST", "127.0.0.1")
+PORT = int(os.getenv("APHASIANET_AUDIO_PORT", "8502"))
+PUBLIC_URL = os.getenv("APHASIANET_AUDIO_URL")
+
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+# Published audio stays available for replays for this long, up to MAX_STREAMS
+STREAM_TTL = 600
+MAX_STREAMS = 64
+
+
+def _content_type(first_chunk):
+    if first_chunk.startswith(b"RIFF"):
+        return "audio/wav"
+    if first_chunk.startswith(b"OggS"):
+        return "audio/ogg"
+    return "audio/mpeg"
+
+
+# Audio that is being produced and served at the same time. Chunks are kept,
+# so every reader gets the whole stream however late it connects.
+class AudioStream:
+    def __init__(self, content_type=None):
+        self.content_type = content_type
+        self.created = time.monotonic()
+        self._chunks = []
+        self._done = False
+        self._condition = threading.Condition()
+
+    def write(self, chunk):
+        if not chunk:
+            return
+        with self._condition:
+            if self.content_type is None:
+                self.content_type = _content_type(bytes(chunk[:4]))
+            self._chunks.append(bytes(chunk))
+            self._condition.notify_all()
+
+    def extend(self, chunks):
+        for chunk in chunks:
+            self.write(chunk)
+
+    # Everything written so far, as one clip
+    def getvalue(self):
+        with self._condition:
+            return b"".join(self._chunks)
+
+    def close(self):
+        with self._condition:
+            self._done = True
+            self._condition.notify_all()
+
+    # Block until the first chunk (or the end) so the content type is known
+    def wait_started(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self._chunks or self._done)
+            return self.content_type or "audio/mpeg"
+
+    def read(self):
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: index < len(self._chunks) or self._done
+                )
+                if index >= len(self._chunks):
+                    return
+                chunk = self._chunks[index]
+            index += 1
+            yield chunk
+
+
+class _AudioHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "AphasiaNetAudio"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stream = self.server.audio_server.get(self.path.rsplit("/", 1)[-1])
+        if stream is None:
+            self.send_error(404)
+            return
+
+        content_type = stream.wait_started()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("Cache-Control", "no-store")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        try:
+            for chunk in stream.read():
+                self.wfile.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The browser stopped or restarted playback
+            self.close_connection = True
+
+
+# Small HTTP server that hands TTS audio to the browser as it arrives, so
+# playback starts on the first chunk and the script thread isn't held up
+class AudioServer:
+    def __init__(self, host=HOST, port=PORT, public_url=PUBLIC_URL):
+        self._streams = OrderedDict()
+        self._lock = threading.Lock()
+        try:
+            self._server = ThreadingHTTPServer((host, port), _AudioHandler)
+        except OSError as e:
+            if public_url or not port:
+                raise
+            # Taken, e.g. by another app on this machine; local browsers can use any port
+            print(f"Audio port {port} unavailable ({e}), using a free port")
+            self._server = ThreadingHTTPServer((host, 0), _AudioHandler)
+        self._server.daemon_threads = True
+        self._server.audio_server = self
+        if not public_url:
+            public_host = "localhost" if host in ("", "0.0.0.0") else host
+            public_url = f"http://{public_host}:{self._server.server_port}"
+        self.base_url = public_url.rstrip("/")
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def _prune(self):
+        now = time.monotonic()
+        while self._streams:
+            stream_id, stream = next(iter(self._streams.items()))
+            if len(self._streams) <= MAX_STREAMS and now - stream.created < STREAM_TTL:
+                break
+            del self._streams[stream_id]
+
+    def get(self, stream_id):
+        with self._lock:
+            return self._streams.get(stream_id)
+
+    # Register an empty stream to write audio into, returns (url, stream)
+    def open_stream(self, content_type=None):
+        stream_id = uuid.uuid4().hex
+        stream = AudioStream(content_type)
+        with self._lock:
+            self._streams[stream_id] = stream
+            self._prune()
+        return f"{self.base_url}/audio/{stream_id}", stream
+
+    # Serve an iterator of audio chunks, read on a background thread. Returns its URL.
+    def publish(self, chunks, content_type=None):
+        url, stream = self.open_stream(content_type)
+        context = contextvars.copy_context()
+
+        def feed():
+            try:
+                stream.extend(chunks)
+            finally:
+                stream.close()
+
+        threading.Thread(target=context.run, args=(feed,), daemon=True).start()
+        return url
+
+    def shutdown(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+# One server per process, shared by every page and session
+@st.cache_resource
+def get_audio_server():
+    return AudioServer()
+
+
+def publish(chunks, content_type=None):
+    return get_audio_server().publish(chunks, content_type)
+
+
+def open_stream(content_type=None):
+    return get_audio_server().open_stream(content_type)
+
+
+# Whether the current browser can fetch audio from the endpoint: it is on this
+# machine, or APHASIANET_AUDIO_URL says where to reach it. An http endpoint
+# can't be used from an https page (mixed content).
+def streaming_available():
+    try:
+        origin = urlparse(st.context.headers.get("Origin") or "")
+    except Exception:
+        origin = urlparse("")
+    if origin.scheme == "https" and not (PUBLIC_URL or "").startswith("https:"):
+        return False
+    return bool(PUBLIC_URL) or not origin.hostname or origin.hostname in LOCAL_HOSTS
+
+
+# Play audio chunks in the browser: streamed through the endpoint when the
+# browser can reach it, otherwise as one clip once synthesis is done
+def play(chunks, content_type=None, autoplay=True):
+    if streaming_available():
+        st.audio(publish(chunks, content_type), autoplay=autoplay)
+        return
+    audio = b"".join(chunks)
+    if audio:
+        st.audio(
+            audio, format=content_type or _content_type(audio[:4]), autoplay=autoplay
+        )
@@ -2,9 +2,14 @@ import streamlit as st
 import azure.cognitiveservices.speech as speechsdk
 import os
 import tempfile
+import time
 import openai
-from elevenlabs import stream
-from elevenlabs.client import ElevenLabs
+import audio_server
+import clients
+import phrases
+from cache import make_key
+import tracing
+import tts
 import utils
 
 # Initialize session state for persistent data
@@ -16,11 +21,22 @@ if "option" not in st.session_state:
     st.session_state.option = "Original"
 if "show_results" not in st.session_state:
     st.session_state.show_results = False
+# Synthesized audio per result, so reruns replay from memory instead of calling TTS
+if "audio_results" not in st.session_state:
+    st.session_state.audio_results = {}
+if "played_text" not in st.session_state:
+    st.session_state.played_text = None
+# When the keyword phrase finishes playing (time.monotonic())
+if "phrase_ends" not in st.session_state:
+    st.session_state.phrase_ends = 0
+
+# Results whose audio is kept in memory per session
+MAX_AUDIO_RESULTS = 8
 
 # Setup clients
 elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY", "")
 openai_api_key = os.getenv("OPENAI_API_KEY", "")
-eleven_client = ElevenLabs(api_key=elevenlabs_api_key)
+eleven_client = clients.get_elevenlabs_client(elevenlabs_api_key)
 openai.api_key = openai_api_key
 
 # Use fixed models to avoid reloading
@@ -28,49 +44,159 @@ llm_model = "gpt-4o-mini"
 voice_id = "JBFqnCBsd6RMkjVDRZzb"
 tts_model = "eleven_multilingual_v2"
 
+# Pre-synthesized audio for the keyword icon phrases
+phrase_bank = phrases.load_phrase_bank(voice_id, tts_model, eleven_client)
+
 
 # Functions to handle state changes without page reload
 def update_option(value):
     st.session_state.option = value
 
 
+# Speak the keyword phrases, and note when they end so the result waits for them
+def speak_keywords(keywords):
+    seconds = phrases.play_keywords(phrase_bank, keywords)
+    st.session_state.phrase_ends = time.monotonic() + seconds
+
+
 def start_transcription():
+    tracing.new_request()
+    with st.spinner("Listening..."):
+        # Show partial hypotheses live while the patient is speaking
+        live_text = st.empty()
+        finals = []
+        with tracing.span("recognize_from_microphone") as span:
+            for kind, result in utils.get_recognizer_session().listen():
+                if kind == "final":
+                    finals.append(result)
+                    live_text.text(" ".join(finals))
+                else:
+                    span.mark_first_byte()
+                    live_text.text(" ".join(finals + [result]))
+            span.record(bytes_out=tracing.payload_size(" ".join(finals)))
+        live_text.empty()
+
     with st.spinner("Processing speech..."):
-        text = utils.recognize_from_microphone()
+        text = " ".join(finals)
         if text:
             st.session_state.original_text = text
 
             st.info("Processing text with AI...")
-            processed_text = utils.process_with_openai(text, llm_model)
-            keywords = utils.get_keywords_openai(text, llm_model)
+            if st.session_state.combined_call:
+                processed_text, keywords = utils.process_and_get_keywords_combined(
+                    text, llm_model
+                )
+                speak_keywords(keywords)
+            else:
+                # Play the cached keyword phrase (e.g. "pain") before cleanup is done
+                processed_text, keywords = utils.process_and_get_keywords(
+                    text,
+                    llm_model,
+                    on_keywords=speak_keywords,
+                )
             st.session_state.processed_text = processed_text
             st.session_state.show_results = True
             st.success("Processing complete!")
-            st.text(f"Keywords: {keywords}")
-            if keywords != "":
-                for k in keywords.split(","):
-                    st.image(f"icons/{k}.png")
+            st.text(f"Keywords: {', '.join(keywords or [])}")
+            for k in keywords or []:
+                st.image(f"icons/{k}.png")
 
         else:
             st.error("No speech detected or error in speech recognition.")
 
 
+# ElevenLabs voice, with the on-device voice taking over when the cloud is
+# slow or unreachable
+def get_speaker():
+    return tts.FallbackTTS(
+        tts.ElevenLabsTTS(eleven_client, voice_id, tts_model, cached=False),
+        tts.LocalTTS(),
+        short_local=st.session_state.short_local,
+    )
+
+
+# Same text, voice and engine settings sound the same, so they share audio
+def audio_key(text):
+    return make_key("tts", text, voice_id, tts_model, st.session_state.short_local)
+
+
+# Keep the audio as it streams, and store it once playback is complete
+def _remember(results, key, audio_stream):
+    chunks = []
+    for chunk in audio_stream:
+        chunks.append(chunk)
+        yield chunk
+    results[key] = b"".join(chunks)
+    while len(results) > MAX_AUDIO_RESULTS:
+        results.pop(next(iter(results)))
+
+
+# Audio for the processed text, synthesized at most once per session
 def play_audio():
+    text_to_convert = st.session_state.processed_text
+    key = audio_key(text_to_convert)
+    results = st.session_state.audio_results
+    if key in results:
+        return iter([results[key]])
+
     with st.spinner("Converting text to speech..."):
-        text_to_convert = st.session_state.processed_text
+        audio_stream = get_speaker().synthesize(text_to_convert)
+    if audio_stream is None:
+        return None
+    return _remember(results, key, audio_stream)
+
+
+# Results section. Runs as a fragment, so its widgets only rerun this part of
+# the page, and a result is only spoken automatically the first time it is shown.
+@st.fragment
+def show_results():
+    col1, col2 = st.columns(2)
+
+    with col1:
+        st.subheader("Original Transcription")
+        st.text_area(
+            "", st.session_state.original_text, height=200, key="original_text_area"
+        )
 
-        audio_stream = utils.text_to_speech(
-            text_to_convert, voice_id, tts_model, eleven_client
+    with col2:
+        st.subheader("Processed Transcription")
+        st.text_area(
+            "",
+            st.session_state.processed_text,
+            height=200,
+            key="processed_text_area",
         )
+
+    if st.session_state.played_text != st.session_state.processed_text:
+        st.session_state.played_text = st.session_state.processed_text
+        audio_stream = play_audio()
+        if audio_stream:
+            # Start the sentence once the keyword phrase has been heard
+            time.sleep(max(0, st.session_state.phrase_ends - time.monotonic()))
+            audio_server.play(audio_stream)
+    elif st.button("Play again"):
+        audio_stream = play_audio()
         if audio_stream:
-            # Return the audio stream to be played
-            return audio_stream
-    return None
+            audio_server.play(audio_stream)
+
+    if show_latency:
+        tracing.latency_panel()
 
 
 # App title
 st.title("Speech Processing Demo")
 
+st.sidebar.checkbox(
+    "Single LLM call for cleanup and keywords", value=False, key="combined_call"
+)
+st.sidebar.checkbox(
+    "Speak short phrases with the on-device voice",
+    value=False,
+    key="short_local",
+    disabled=not tts.LocalTTS().available(),
+)
+show_latency = st.sidebar.checkbox("Show latency breakdown", value=False)
+
 # Create container for the transcribe button
 transcribe_container = st.container()
 with transcribe_container:
@@ -79,26 +205,7 @@ with transcribe_container:
 
 # Only show results if transcription has been done
 if st.session_state.show_results:
-    results_container = st.container()
-    with results_container:
-        col1, col2 = st.columns(2)
-
-        with col1:
-            st.subheader("Original Transcription")
-            st.text_area(
-                "", st.session_state.original_text, height=200, key="original_text_area"
-            )
-
-        with col2:
-            st.subheader("Processed Transcription")
-            st.text_area(
-                "",
-                st.session_state.processed_text,
-                height=200,
-                key="processed_text_area",
-            )
-    audio_stream = play_audio()
-    stream(audio_stream)
+    show_results()
 
     # options_container = st.container()
     # with options_container:
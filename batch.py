@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import cleanup
+import clients
+import resilience
+import utils
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".m4a", ".ogg")
+
+
+# Spaces out requests across all workers to stay under a provider's rate limit
+class RateLimiter:
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute if per_minute else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0, self._next - now)
+            self._next = max(now, self._next) + self.interval
+        if delay:
+            time.sleep(delay)
+
+
+# Files already written to the output without an error are skipped on rerun
+def load_finished(output_path):
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if not record.get("error"):
+                finished.add(record["file"])
+    return finished
+
+
+def list_audio_files(directory):
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.lower().endswith(AUDIO_EXTENSIONS)
+    )
+
+
+# Retries happen inside the provider helpers (resilience.call), which back off
+# only on errors a second try can fix, such as rate limits and timeouts.
+# Rate limits are applied there too, per request sent, so cache hits are free.
+def process_file(path, args, client):
+    record = {"file": path}
+    started = time.perf_counter()
+
+    with utils.collect_errors() as errors:
+        transcript = utils.cached_speech_to_text(path, args.stt_model, client)
+    record["stt_seconds"] = round(time.perf_counter() - started, 3)
+    if transcript is None:
+        record["error"] = "; ".join(errors) or "speech-to-text failed"
+        return record
+    record["transcript"] = transcript
+
+    cleanup_started = time.perf_counter()
+    with utils.collect_errors() as errors:
+        cleaned = cleanup.cached_clean(transcript, args.llm_model, args.fluent)
+    record["llm_seconds"] = round(time.perf_counter() - cleanup_started, 3)
+    if cleaned is None:
+        record["error"] = "; ".join(errors) or "cleanup failed"
+        return record
+    record["processed_text"] = cleaned
+    return record
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Transcribe and clean up a folder of recordings."
+    )
+    parser.add_argument("directory", help="folder of audio files")
+    parser.add_argument("-o", "--output", default="results.jsonl")
+    parser.add_argument("-w", "--workers", type=int, default=4)
+    parser.add_argument("--stt-model", default="scribe_v1")
+    parser.add_argument("--llm-model", default="gpt-4o-mini")
+    parser.add_argument("--fluent", action="store_true")
+    parser.add_argument(
+        "--stt-rpm", type=int, default=60, help="speech-to-text requests per minute"
+    )
+    parser.add_argument(
+        "--llm-rpm", type=int, default=500, help="OpenAI requests per minute"
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        default=resilience.RETRIES,
+        help="retries per request for transient errors",
+    )
+    args = parser.parse_args()
+    resilience.RETRIES = args.retries
+
+    finished = load_finished(args.output)
+    files = [f for f in list_audio_files(args.directory) if f not in finished]
+    print(f"{len(files)} files to process ({len(finished)} already done)")
+
+    client = clients.get_elevenlabs_client()
+    resilience.LIMITERS["elevenlabs_stt"] = RateLimiter(args.stt_rpm)
+    resilience.LIMITERS["openai"] = RateLimiter(args.llm_rpm)
+
+    started = time.perf_counter()
+    failed = 0
+    with open(args.output, "a", encoding="utf-8") as out:
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [
+                executor.submit(process_file, path, args, client) for path in files
+            ]
+            for future in as_completed(futures):
+                record = future.result()
+                out.write(json.dumps(record) + "\n")
+                out.flush()
+                failed += bool(record.get("error"))
+                print(f"{record['file']}: {record.get('error', 'done')}")
+
+    elapsed = time.perf_counter() - started
+    print(f"Processed {len(files)} files in {elapsed:.1f}s ({failed} failed)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+import argparse
+import json
+import os
+import random
+import resource
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import openai
+from elevenlabs.client import ElevenLabs
+from elevenlabs.environment import ElevenLabsEnvironment
+
+import audio_server
+import pipeline
+import tracing
+import utils
+
+FIXTURES_DIR = "audio"
+
+FAKE_TRANSCRIPT = "um I I want uh the the water, water please. My my head, it hurts."
+FAKE_CLEANUP = "I would like some water, please. My head hurts."
+FAKE_KEYWORDS = "pain"
+
+
+# Latency and fault profile for one fake provider endpoint. A share of requests
+# can fail with error_status, or stall for stall_seconds before answering.
+class Profile:
+    def __init__(
+        self,
+        latency,
+        jitter=0.0,
+        chunk_size=4096,
+        chunk_delay=0.0,
+        error_rate=0.0,
+        error_status=503,
+        stall_rate=0.0,
+        stall_seconds=0.0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+
+    def wait(self):
+        stall = self.stall_seconds if random.random() < self.stall_rate else 0.0
+        time.sleep(
+            max(0.0, self.latency + stall + random.uniform(-self.jitter, self.jitter))
+        )
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+
+# Local stand-in for the ElevenLabs STT/TTS and OpenAI chat completion APIs
+class FakeProviderHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    profiles = {}
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = b""
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return body
+                body += self.rfile.read(size)
+                self.rfile.readline()
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _send_json(self, payload):
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status):
+        data = json.dumps({"detail": {"status": "injected_fault"}}).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_chunks(self, content_type, chunks, profile):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for chunk in chunks:
+                self.wfile.write(f"{len(chunk):X}\r\n".encode() + chunk + b"\r\n")
+                self.wfile.flush()
+                time.sleep(profile.chunk_delay)
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # The client dropped the stream, e.g. the losing side of a hedged request
+            self.close_connection = True
+
+    def do_POST(self):
+        body = self._read_body()
+
+        stage = next(
+            (
+                stage
+                for prefix, stage in (
+                    ("/v1/speech-to-text", "stt"),
+                    ("/v1/text-to-speech", "tts"),
+                    ("/v1/chat/completions", "llm"),
+                )
+                if self.path.startswith(prefix)
+            ),
+            None,
+        )
+        if stage and self.profiles[stage].fails():
+            self._send_error(self.profiles[stage].error_status)
+            return
+
+        if stage == "stt":
+            self.profiles["stt"].wait()
+            words = [
+                {"text": w, "type": "word", "start": i * 0.4, "end": i * 0.4 + 0.3}
+                for i, w in enumerate(FAKE_TRANSCRIPT.split())
+            ]
+            self._send_json(
+                {
+                    "language_code": "en",
+                    "language_probability": 1.0,
+                    "text": FAKE_TRANSCRIPT,
+                    "words": words,
+                }
+            )
+        elif stage == "tts":
+            profile = self.profiles["tts"]
+            profile.wait()
+            # Roughly 1 KB of 128 kbps mp3 per 16 characters of text
+            audio = os.urandom(max(1, len(body) // 16) * 1024)
+            size = profile.chunk_size
+            chunks = [audio[i : i + size] for i in range(0, len(audio), size)]
+            self._send_chunks("audio/mpeg", chunks, profile)
+        elif stage == "llm":
+            profile = self.profiles["llm"]
+            profile.wait()
+            request = json.loads(body)
+            system = request["messages"][0]["content"]
+            content = FAKE_KEYWORDS if "keywords" in system else FAKE_CLEANUP
+            if request.get("stream"):
+                self._send_chunks(
+                    "text/event-stream", _completion_events(content, profile), profile
+                )
+            else:
+                self._send_json(_completion(content))
+        else:
+            self.send_error(404)
+
+
+def _completion(content):
+    return {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": "fake",
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }
+        ],
+        "usage": {
+            "prompt_tokens": 120,
+            "completion_tokens": len(content) // 4,
+            "total_tokens": 120 + len(content) // 4,
+        },
+    }
+
+
+def _completion_events(content, profile):
+    size = max(1, profile.chunk_size // 256)
+    for i in range(0, len(content), size):
+        chunk = {
+            "id": "chatcmpl-fake",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "fake",
+            "choices": [
+                {
+                    "index": 0,
+                    "delta": {"content": content[i : i + size]},
+                    "finish_reason": None,
+                }
+            ],
+        }
+        yield f"data: {json.dumps(chunk)}\n\n".encode()
+    yield b"data: [DONE]\n\n"
+
+
+def start_fake_server(profiles):
+    FakeProviderHandler.profiles = profiles
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeProviderHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# One end-to-end request through the same helpers the demo pages use
+def run_session(fixture, client, args):
+    request_id = tracing.new_request()
+    started = time.perf_counter()
+
+    if args.stream:
+        # The same overlapping stages as the app, playing into an in-memory
+        # stream; the "pipeline" span's first byte is the time to first audio
+        player = audio_server.AudioStream()
+        backend = pipeline.CloudBackend(
+            client,
+            args.stt_model,
+            args.llm_model,
+            args.voice_id,
+            args.tts_model,
+            player=player,
+        )
+        pipeline.run_pipeline([fixture], backend, args.fluent)
+        player.close()
+        return request_id, time.perf_counter() - started
+
+    transcription = utils.speech_to_text(fixture, args.stt_model, client)
+    text = getattr(transcription, "text", None)
+    if not text:
+        return request_id, time.perf_counter() - started
+
+    cleaned = utils.process_with_openai(text, args.llm_model, args.fluent)
+    if cleaned:
+        audio = utils.text_to_speech(cleaned, args.voice_id, args.tts_model, client)
+        for _ in audio or []:
+            pass
+
+    return request_id, time.perf_counter() - started
+
+
+def _percentiles(values):
+    if not values:
+        return "n/a"
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return (
+        f"p50 {p50 * 1000:7.1f} ms  p95 {p95 * 1000:7.1f} ms  p99 {p99 * 1000:7.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the STT -> LLM -> TTS pipeline against local fake providers."
+    )
+    parser.add_argument(
+        "-n", "--sessions", type=int, default=4, help="concurrent sessions"
+    )
+    parser.add_argument(
+        "-r", "--requests", type=int, default=20, help="requests per session"
+    )
+    parser.add_argument("--stt-latency", type=float, default=0.8)
+    parser.add_argument("--llm-latency", type=float, default=0.6)
+    parser.add_argument("--tts-latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--chunk-size", type=int, default=4096)
+    parser.add_argument("--chunk-delay", type=float, default=0.01)
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="share of provider requests that fail",
+    )
+    parser.add_argument(
+        "--error-status", type=int, default=503, help="status code for failed requests"
+    )
+    parser.add_argument(
+        "--stall-rate", type=float, default=0.0, help="share of TTS requests that stall"
+    )
+    parser.add_argument("--stall-seconds", type=float, default=3.0)
+    parser.add_argument(
+        "--hedge-after",
+        type=float,
+        default=utils.TTS_HEDGE_AFTER,
+        help="send a duplicate TTS request after this many seconds without audio",
+    )
+    parser.add_argument("--fluent", action="store_true")
+    parser.add_argument(
+        "--stream", action="store_true", help="stream cleanup and speak per sentence"
+    )
+    parser.add_argument("--stt-model", default="scribe_v1")
+    parser.add_argument("--llm-model", default="gpt-4o-mini")
+    parser.add_argument("--voice-id", default="JBFqnCBsd6RMkjVDRZzb")
+    parser.add_argument("--tts-model", default="eleven_multilingual_v2")
+    args = parser.parse_args()
+    utils.TTS_HEDGE_AFTER = args.hedge_after
+
+    faults = {"error_rate": args.error_rate, "error_status": args.error_status}
+    profiles = {
+        "stt": Profile(args.stt_latency, args.jitter, **faults),
+        "llm": Profile(
+            args.llm_latency, args.jitter, args.chunk_size, args.chunk_delay, **faults
+        ),
+        "tts": Profile(
+            args.tts_latency,
+            args.jitter,
+            args.chunk_size,
+            args.chunk_delay,
+            stall_rate=args.stall_rate,
+            stall_seconds=args.stall_seconds,
+            **faults,
+        ),
+    }
+    server = start_fake_server(profiles)
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    # Point the shared OpenAI client at the fake server
+    os.environ["OPENAI_BASE_URL"] = f"{base_url}/v1"
+    openai.api_key = "fake"
+    # base_url is forced to https on the default port, so pass a custom environment
+    client = ElevenLabs(
+        api_key="fake",
+        environment=ElevenLabsEnvironment(
+            base=base_url, wss=base_url.replace("http", "ws")
+        ),
+    )
+
+    fixtures = sorted(
+        os.path.join(FIXTURES_DIR, name)
+        for name in os.listdir(FIXTURES_DIR)
+        if name.lower().endswith((".mp3", ".wav"))
+    )
+
+    # Warm up clients and connections so one-off setup doesn't skew the tail
+    tracing.TRACE_FILE = os.devnull
+    run_session(fixtures[0], client, args)
+    tracing.flush()
+
+    trace_file = tempfile.NamedTemporaryFile(suffix=".jsonl", delete=False).name
+    tracing.TRACE_FILE = trace_file
+    jobs = [fixtures[i % len(fixtures)] for i in range(args.sessions * args.requests)]
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        results = list(executor.map(lambda f: run_session(f, client, args), jobs))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    server.shutdown()
+    tracing.flush()
+
+    stages = {}
+    with open(trace_file, "r", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            stages.setdefault(entry["stage"], []).append(entry)
+    os.unlink(trace_file)
+
+    print(f"{len(results)} requests, {args.sessions} concurrent sessions")
+    print(f"{'end-to-end':<28}{_percentiles([seconds for _, seconds in results])}")
+    for stage, entries in sorted(stages.items()):
+        print(f"{stage:<28}{_percentiles([e['seconds'] for e in entries])}")
+        errors = sum("error" in e for e in entries)
+        if errors:
+            print(f"{'  errors':<28}{errors} of {len(entries)}")
+        first_bytes = [e["ttfb"] for e in entries if e.get("ttfb") is not None]
+        if first_bytes:
+            label = "  first audio" if stage == "pipeline" else "  first byte"
+            print(f"{label:<28}{_percentiles(first_bytes)}")
+    print(f"{'throughput':<28}{len(results) / elapsed:.2f} requests/s")
+    print(f"{'peak Python memory':<28}{peak / 1024 / 1024:.1f} MB")
+    print(
+        f"{'peak RSS':<28}{resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MB"
+    )
+
+
+if __name__ == "__main__":
+    main()
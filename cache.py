@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+
+CACHE_DIR = os.getenv("APHASIANET_CACHE_DIR", ".cache")
+MAX_BYTES = 512 * 1024 * 1024
+TTL_SECONDS = 7 * 24 * 60 * 60
+CHUNK_SIZE = 64 * 1024
+
+
+# Hash of everything that affects a provider response (audio/text, model, voice, ...)
+def make_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        elif not isinstance(part, (bytes, bytearray, memoryview)):
+            part = repr(part).encode("utf-8")
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+# Disk-backed cache with TTL and least-recently-used eviction.
+# File mtime is the creation time (for TTL) and atime is the last access (for LRU).
+class DiskCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_BYTES, ttl=TTL_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key, suffix):
+        return os.path.join(self.directory, key + suffix)
+
+    # Return the path of a live entry, or None if missing or expired
+    def get_path(self, key, suffix):
+        path = self._path(key, suffix)
+        try:
+            created = os.stat(path).st_mtime
+        except FileNotFoundError:
+            return None
+
+        now = time.time()
+        if now - created > self.ttl:
+            self._remove(path)
+            return None
+
+        os.utime(path, (now, created))
+        return path
+
+    def get_json(self, key):
+        path = self.get_path(key, ".json")
+        if path is None:
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            self._remove(path)
+            return None
+
+    def set_json(self, key, value):
+        self._write(key, ".json", [json.dumps(value).encode("utf-8")])
+
+    # Stream a cached file back in chunks
+    def read_chunks(self, path):
+        with open(path, "rb") as f:
+            while chunk := f.read(CHUNK_SIZE):
+                yield chunk
+
+    # Pass chunks through to the caller while writing them to the cache.
+    # The entry is only committed once the whole stream has been consumed.
+    def tee_chunks(self, key, suffix, chunks):
+        tmp_path = self._path(key, f"{suffix}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            os.replace(tmp_path, self._path(key, suffix))
+        finally:
+            if os.path.exists(tmp_path):
+                self._remove(tmp_path)
+        self.evict()
+
+    def _write(self, key, suffix, chunks):
+        for _ in self.tee_chunks(key, suffix, chunks):
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    # Drop expired entries, then the least recently used ones until under max_bytes
+    def evict(self):
+        with self._lock:
+            now = time.time()
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                if not entry.is_file() or entry.name.endswith(".tmp"):
+                    continue
+                stat = entry.stat()
+                if now - stat.st_mtime > self.ttl:
+                    self._remove(entry.path)
+                    continue
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+                total += stat.st_size
+
+            entries.sort()
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                self._remove(path)
+                total -= size
@@ -0,0 +1,54 @@
+import os
+import time
+import uuid
+import wave
+from array import array
+
+SAMPLE_RATE = 16000
+FRAME_LENGTH = 512
+
+RECORDINGS_DIR = "audio"
+
+
+# Unique per-session WAV path, so recordings never overwrite each other
+def new_recording_path(directory=RECORDINGS_DIR, prefix="recording"):
+    os.makedirs(directory, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    return os.path.join(directory, f"{prefix}-{stamp}-{uuid.uuid4().hex[:8]}.wav")
+
+
+# Appends frames to a WAV file as they arrive. The wave module patches the
+# header lengths after every write, so the file is valid (and readable by
+# downstream speech-to-text) while recording is still in progress.
+class WavStreamWriter:
+    def __init__(self, path, sample_rate=SAMPLE_RATE):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.frames_written = 0
+        self._file = open(path, "wb")
+        self._wav = wave.open(self._file, "wb")
+        self._wav.setnchannels(1)
+        self._wav.setsampwidth(2)
+        self._wav.setframerate(sample_rate)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def seconds(self):
+        return self.frames_written / self.sample_rate
+
+    # Append one frame (list of int16 samples from PvRecorder.read())
+    def write(self, frame):
+        samples = array("h", frame)
+        self._wav.writeframes(samples)
+        self._file.flush()
+        self.frames_written += len(samples)
+
+    def close(self):
+        if not self._file.closed:
+            self._wav.close()
+            self._file.close()
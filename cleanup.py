@@ -0,0 +1,206 @@
+import math
+import re
+
+import streamlit as st
+
+import tracing
+import utils
+from cache import make_key
+
+# Optional exact token counts: pip install tiktoken
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Transcripts up to this many tokens are cleaned in one request. Longer ones
+# are split into chunks of about this size, so each cleaned chunk fits in
+# the 1024-token completion limit.
+CHUNK_TOKENS = 600
+
+# Each join between chunks (the sentence either side of it) gets a small LLM
+# pass for coherence, unless those two sentences are longer than this; then
+# only the local fix-ups are applied there
+REDUCE_TOKENS = 800
+
+# Characters per token when tiktoken isn't installed
+CHARS_PER_TOKEN = 4
+
+REDUCE_PROMPT = "You are given the end of one passage of cleaned-up speech and, on the next line, the start of the passage that follows it in the same conversation. Join them into coherent text: fix an awkward join and remove a sentence repeated at the join. Do not add, summarize or drop content. Just output the joined text with no headings or styling."
+
+_UTTERANCE_END = re.compile(r"\n+|(?<=[.!?])\s+")
+
+
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+
+# Token count of the text, counted locally before any request is made
+def estimate_tokens(text, model="gpt-4o-mini"):
+    if not text:
+        return 0
+    if tiktoken is not None:
+        return len(_encoding(model).encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+# Split a transcript into chunks of at most max_tokens, breaking between
+# utterances (lines or sentences), and between words only inside a very
+# long utterance
+def split_transcript(text, max_tokens=CHUNK_TOKENS, model="gpt-4o-mini"):
+    units = []
+    for utterance in _UTTERANCE_END.split(text):
+        utterance = utterance.strip()
+        if not utterance:
+            continue
+        if estimate_tokens(utterance, model) <= max_tokens:
+            units.append(utterance)
+            continue
+        words = []
+        size = 0
+        for word in utterance.split():
+            word_tokens = estimate_tokens(f" {word}", model)
+            if words and size + word_tokens > max_tokens:
+                units.append(" ".join(words))
+                words, size = [], 0
+            words.append(word)
+            size += word_tokens
+        units.append(" ".join(words))
+
+    chunks = []
+    current = []
+    size = 0
+    for unit in units:
+        unit_tokens = estimate_tokens(f" {unit}", model)
+        if current and size + unit_tokens > max_tokens:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+        current.append(unit)
+        size += unit_tokens
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+
+def _sentences(text):
+    return [s.strip() for s in _UTTERANCE_END.split(text) if s.strip()]
+
+
+def _normalize(sentence):
+    return re.sub(r"[^\w\s]", "", sentence).lower().strip()
+
+
+# Drop a sentence repeated across a chunk boundary
+def join_chunks(pieces):
+    sentences = []
+    for piece in pieces:
+        piece_sentences = _sentences(piece)
+        if (
+            sentences
+            and piece_sentences
+            and _normalize(piece_sentences[0]) == _normalize(sentences[-1])
+        ):
+            piece_sentences = piece_sentences[1:]
+        sentences.extend(piece_sentences)
+    return " ".join(sentences)
+
+
+def _reduce(text, model, timeout):
+    with tracing.span(
+        "reduce_cleanup", model=model, bytes_in=tracing.payload_size(text)
+    ) as span:
+        response = utils.chat(
+            timeout,
+            model=model,
+            messages=[
+                {"role": "system", "content": REDUCE_PROMPT},
+                {"role": "user", "content": text},
+            ],
+            temperature=utils.LLM_TEMPERATURE,
+            max_tokens=1024,
+        )
+        reduced = response.choices[0].message.content
+        span.record(
+            bytes_out=tracing.payload_size(reduced), **utils.token_usage(response)
+        )
+    return reduced
+
+
+# Smooth each join between cleaned chunks with the LLM, sending only the last
+# sentence before it and the first one after, so the reduce stays small however
+# long the transcript. Joins that fail keep the local fix-ups from join_chunks.
+def reduce_seams(pieces, model, timeout=utils.LLM_TIMEOUT):
+    pieces = [_sentences(piece) for piece in pieces]
+    seams = {}
+    claimed = set()
+    for index in range(len(pieces) - 1):
+        tail, head = pieces[index], pieces[index + 1]
+        # A one-sentence chunk can only take part in one join
+        if not tail or not head or (index, len(tail) - 1) in claimed:
+            continue
+        text = f"{tail[-1]}\n{head[0]}"
+        if estimate_tokens(text, model) > REDUCE_TOKENS:
+            continue
+        claimed.update({(index, len(tail) - 1), (index + 1, 0)})
+        seams[index] = utils.submit(_reduce, text, model, timeout)
+
+    failed = 0
+    for index, future in seams.items():
+        try:
+            joined = utils.wait_result(future, timeout, "reduce")
+        except Exception:
+            joined = None
+        if not joined:
+            failed += 1
+            continue
+        pieces[index][-1] = joined.strip()
+        pieces[index + 1] = pieces[index + 1][1:]
+    if failed:
+        st.warning(f"OpenAI API error, using the chunks as cleaned at {failed} join(s)")
+    return join_chunks(" ".join(piece) for piece in pieces if piece)
+
+
+# Clean up a transcript of any length. Short ones take a single request;
+# long ones are cleaned chunk by chunk in parallel (map), then the joins
+# between chunks get a light reduce pass, so per-request latency doesn't grow
+# with the session.
+def clean(text, model, fluent=False, timeout=utils.LLM_TIMEOUT, diarized=False):
+    if estimate_tokens(text, model) <= CHUNK_TOKENS:
+        return utils.process_with_openai(text, model, fluent, timeout, diarized)
+
+    chunks = split_transcript(text, CHUNK_TOKENS, model)
+    futures = [
+        utils.submit(utils.process_with_openai, chunk, model, fluent, timeout, diarized)
+        for chunk in chunks
+    ]
+    pieces = [utils.wait_result(future, timeout, "cleanup") for future in futures]
+    if not any(pieces):
+        return None
+    # A chunk that failed is kept as transcribed rather than lost
+    return reduce_seams(
+        [piece if piece else chunk for piece, chunk in zip(pieces, chunks)],
+        model,
+        timeout,
+    )
+
+
+# Cached clean(), sharing keys with utils.cached_process_with_openai
+def cached_clean(text, model, fluent=False, diarized=False):
+    key = make_key(
+        "llm",
+        text,
+        model,
+        utils.cleanup_prompt(fluent, diarized),
+        utils.LLM_TEMPERATURE,
+    )
+    cached = utils.response_cache.get_json(key)
+    if cached is not None:
+        return cached["text"]
+
+    cleaned_text = clean(text, model, fluent, diarized=diarized)
+    if cleaned_text is not None:
+        utils.response_cache.set_json(key, {"text": cleaned_text})
+    return cleaned_text
@@ -0,0 +1,48 @@
+import os
+
+import azure.cognitiveservices.speech as speechsdk
+import httpx
+import openai
+import streamlit as st
+from elevenlabs.client import ElevenLabs
+
+# Shared HTTP settings: keep connections alive between requests so repeat
+# calls skip the TCP/TLS handshake
+HTTP_TIMEOUT = 60
+HTTP_LIMITS = httpx.Limits(
+    max_connections=32, max_keepalive_connections=16, keepalive_expiry=300
+)
+
+
+def _http_client():
+    return httpx.Client(limits=HTTP_LIMITS, timeout=HTTP_TIMEOUT)
+
+
+# Clients are created lazily on first use and shared across reruns and sessions.
+# SDK retries are off; resilience.call handles them with a shared deadline.
+@st.cache_resource
+def get_elevenlabs_client(api_key=None):
+    return ElevenLabs(
+        api_key=api_key or os.getenv("ELEVENLABS_API_KEY"),
+        httpx_client=_http_client(),
+    )
+
+
+@st.cache_resource
+def get_openai_client(api_key=None):
+    return openai.OpenAI(
+        api_key=api_key or os.getenv("OPENAI_API_KEY"),
+        http_client=_http_client(),
+        max_retries=0,
+    )
+
+
+# This requires environment variables named "SPEECH_KEY" and "SPEECH_REGION"
+@st.cache_resource
+def get_speech_config(language="en-US"):
+    speech_config = speechsdk.SpeechConfig(
+        subscription=os.environ.get("SPEECH_KEY"),
+        region=os.environ.get("SPEECH_REGION"),
+    )
+    speech_config.speech_recognition_language = language
+    return speech_config
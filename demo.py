@@ -1,9 +1,18 @@
 import streamlit as st
 import os
-import tempfile
+import wave
 import openai
-from elevenlabs import stream
-from elevenlabs.client import ElevenLabs
+import audio_server
+import cleanup
+import clients
+import diarize
+import long_audio
+import pipeline
+import stt
+import tracing
+import transcode
+import utils
+import vad
 
 # Set page configuration
 st.set_page_config(page_title="Speech Processing Demo", layout="wide")
@@ -57,16 +66,31 @@ with st.sidebar:
     stt_model = st.selectbox(
         "Speech-to-Text Model", ["scribe_v1", "scribe_v2"], index=0
     )
+    local_available = stt.LocalSTT().available()
+    local_stt = st.checkbox(
+        "Transcribe short clips on this machine",
+        value=local_available,
+        disabled=not local_available,
+        help="Needs faster-whisper. Short clips skip the upload; longer ones still use ElevenLabs.",
+    )
 
     # OpenAI model selection
     llm_model = st.selectbox("OpenAI Model", ["gpt-4o-mini"], index=0)
 
+    separate_speakers = st.checkbox(
+        "Keep only the patient's speech",
+        value=False,
+        help="Separates speakers and sends only the main speaker's turns to cleanup.",
+    )
+
+    show_latency = st.checkbox("Show latency breakdown", value=False)
+
 
 # Function to initialize API clients
 def initialize_clients():
     # ElevenLabs client
     if elevenlabs_api_key:
-        eleven_client = ElevenLabs(api_key=elevenlabs_api_key)
+        eleven_client = clients.get_elevenlabs_client(elevenlabs_api_key)
     else:
         st.error("Please provide your ElevenLabs API key")
         st.stop()
@@ -81,71 +105,12 @@ def initialize_clients():
     return eleven_client
 
 
-# Function for text-to-speech
-def text_to_speech(text, voice_id, model_id, client):
-    try:
-        audio_stream = client.text_to_speech.convert_as_stream(
-            text=text,
-            voice_id=voice_id,
-            model_id=model_id,
-        )
-        return audio_stream
-    except Exception as e:
-        st.error(f"Text-to-speech error: {e}")
-        return None
-
-
-# Function for speech-to-text
-def speech_to_text(file_path, model_id, client):
-    try:
-        with open(file_path, "rb") as file_data:
-            result = client.speech_to_text.convert(
-                model_id=model_id,
-                file=file_data,
-            )
-        return result
-    except Exception as e:
-        st.error(f"Speech-to-text error: {e}")
-        return None
-
-
-# Function to process text with OpenAI
-def process_with_openai(text, model, fluent=False):
-    if not fluent:
-        prompt = "You are a helpful assistant that cleans up transcribed speech. Remove filler words like 'um', 'uh', 'like', etc. Fix grammar issues. Just output the text as-is with no headings or styling."
-    else:
-        prompt = """
-        I'll give you some conversations or monologue from aphasia patients. For each piece of text, do the following:
-        Check if there's more than one person talking. If so, only keep the words of aphasia patients.
-        Determine whether it's Broca's aphasia or Wernicke's aphasia:
-        For Broca's aphasia, make the words into grammarly correct, coherent, concise sentences that fully covers what they’re trying to say.
-        For Wernicke's aphasia, guess what is the actual meaning of the patient, and turn that into logical, meaningful sentences that others could understand.
-        Generate the output with only the converted text and nothing else.    
-        """
-
-    try:
-        response = openai.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": prompt,
-                },
-                {
-                    "role": "user",
-                    "content": f"Clean up and summarize this transcribed speech: {text}",
-                },
-            ],
-            temperature=0.3,
-            max_tokens=1024,
-        )
-
-        # Extract the content from the response
-        cleaned_text = response.choices[0].message.content
-        return cleaned_text
-    except Exception as e:
-        st.error(f"OpenAI API error: {e}")
-        return None
+# Speech-to-text engine: ElevenLabs, with short clips kept local when enabled
+def speech_backend(eleven_client):
+    return stt.SttRouter(
+        stt.ElevenLabsSTT(eleven_client, stt_model),
+        stt.LocalSTT() if local_stt else None,
+    )
 
 
 # Main app layout
@@ -166,20 +131,80 @@ with tab1:
     )
 
     if process_button and uploaded_file is not None:
+        tracing.new_request()
         with st.spinner("Processing audio..."):
             # Initialize clients
             eleven_client = initialize_clients()
 
-            # Save uploaded file to temp file
-            with tempfile.NamedTemporaryFile(
-                delete=False, suffix="." + uploaded_file.name.split(".")[-1]
-            ) as tmp_file:
-                tmp_file.write(uploaded_file.getvalue())
-                tmp_filepath = tmp_file.name
-
-            # Speech to text
-            st.info("Converting speech to text...")
-            transcription = speech_to_text(tmp_filepath, stt_model, eleven_client)
+            # Long recordings are split in pauses and transcribed in parallel,
+            # when they can be decoded here (WAV, or anything with ffmpeg)
+            long_result = None
+            if stt.clip_seconds(uploaded_file) > long_audio.MAX_CHUNK_SECONDS:
+                st.info("Converting speech to text in parallel parts...")
+                try:
+                    long_result = long_audio.cached_transcribe_long(
+                        uploaded_file, stt_model, eleven_client
+                    )
+                except (ValueError, RuntimeError) as e:
+                    st.info(f"Sending the recording in one request ({e})")
+                uploaded_file.seek(0)
+
+            if long_result is not None:
+                transcription, words, failed = long_result
+                if failed:
+                    st.warning(
+                        f"{len(failed)} part(s) of the recording could not be transcribed"
+                    )
+                st.session_state["speech_segments"] = []
+                speaker_audio = uploaded_file
+            else:
+                # Downmix, resample, trim silence and compress before upload.
+                # The upload is passed to speech-to-text in memory, without a temp file.
+                audio = uploaded_file
+                extension = uploaded_file.name.split(".")[-1]
+                speech_segments = []
+                duration = None
+                if transcode.available():
+                    audio_bytes, extension, upload_stats, speech_segments = (
+                        transcode.prepare_upload(
+                            uploaded_file.getbuffer(), extension, trim=vad.trim_silence
+                        )
+                    )
+                    audio = memoryview(audio_bytes)
+                    duration = upload_stats["duration"]
+                    st.info(
+                        f"Upload size: {upload_stats['input_kb']} KB -> {upload_stats['output_kb']} KB "
+                        f"({upload_stats['ratio']}x smaller, {upload_stats['seconds']}s)"
+                    )
+                elif extension.lower() == "wav":
+                    try:
+                        trimmed_bytes, speech_segments = vad.trim_wav_bytes(
+                            uploaded_file
+                        )
+                    except (ValueError, wave.Error, EOFError):
+                        # Not 16-bit PCM: upload it as it is
+                        trimmed_bytes, speech_segments = None, []
+                    uploaded_file.seek(0)
+                    if speech_segments:
+                        st.info(
+                            f"Trimmed silence: {uploaded_file.size // 1024} KB -> {len(trimmed_bytes) // 1024} KB"
+                        )
+                        audio = memoryview(trimmed_bytes)
+                st.session_state["speech_segments"] = speech_segments
+
+                # Speech to text
+                st.info("Converting speech to text...")
+                speaker_audio = audio
+                if separate_speakers:
+                    # Timed words with speaker labels, for filtering by speaker
+                    words = diarize.cached_transcribe_words(
+                        audio, stt_model, eleven_client, filename=f"upload.{extension}"
+                    )
+                    transcription = long_audio.words_to_text(words) if words else None
+                else:
+                    transcription = speech_backend(eleven_client).transcribe(
+                        audio, filename=f"upload.{extension}", seconds=duration
+                    )
 
             if transcription:
                 st.session_state["original_text"] = transcription
@@ -188,16 +213,113 @@ with tab1:
                 st.info("Processing text with AI...")
                 fluent_bool = fluent_option == "Fluent"
                 print("Using", fluent_bool)
-                processed_text = process_with_openai(
-                    transcription, llm_model, fluent_bool
+
+                # Drop other speakers' turns locally instead of paying the LLM to
+                # find and discard them
+                cleanup_input = transcription
+                diarized = False
+                st.session_state["speaker_turns"] = None
+                if separate_speakers and words:
+                    turns = diarize.speaker_turns(words, speaker_audio)
+                    # Labels only exist when the STT or local clustering separated voices
+                    diarized = any(turn["speaker"] is not None for turn in turns)
+                    cleanup_input, speaker, speaker_count = diarize.patient_text(turns)
+                    if speaker_count > 1:
+                        st.session_state["speaker_turns"] = turns
+                        st.session_state["patient_speaker"] = speaker
+                        st.info(
+                            f"Kept {speaker}'s speech: {len(cleanup_input.split())} of "
+                            f"{len(transcription.split())} words from {speaker_count} speakers. "
+                            "Pick another speaker below if this isn't the patient."
+                        )
+
+                processed_text = cleanup.cached_clean(
+                    cleanup_input, llm_model, fluent_bool, diarized=diarized
                 )
 
                 if processed_text:
                     st.session_state["processed_text"] = processed_text
                     st.success("Processing complete! Go to Results tab.")
 
-            # Clean up temp file
-            os.unlink(tmp_filepath)
+        if show_latency:
+            tracing.latency_panel()
+
+    # With several speakers, the clinician can choose whose speech is cleaned up
+    speaker_turns = st.session_state.get("speaker_turns")
+    if speaker_turns:
+        speaking_time = diarize.speaking_time(speaker_turns)
+        speakers = sorted(speaking_time, key=speaking_time.get, reverse=True)
+        previews = {}
+        for turn in speaker_turns:
+            previews.setdefault(turn["speaker"], " ".join(turn["text"].split()[:8]))
+        patient = st.selectbox(
+            "Patient",
+            speakers,
+            index=speakers.index(st.session_state["patient_speaker"]),
+            format_func=lambda s: f'{s} ({speaking_time[s]:.0f}s): "{previews[s]}..."',
+        )
+        if patient != st.session_state["patient_speaker"]:
+            initialize_clients()
+            with st.spinner("Processing text with AI..."):
+                patient_text, _, _ = diarize.patient_text(speaker_turns, patient)
+                processed_text = cleanup.cached_clean(
+                    patient_text, llm_model, fluent_option == "Fluent", diarized=True
+                )
+            if processed_text:
+                st.session_state["patient_speaker"] = patient
+                st.session_state["processed_text"] = processed_text
+                st.success("Processed the selected speaker. Go to Results tab.")
+
+    # Streaming: speak cleaned sentences while the rest is still being processed
+    speak_button = col2.button("Process & Speak", disabled=uploaded_file is None)
+
+    if speak_button and uploaded_file is not None:
+        tracing.new_request()
+        eleven_client = initialize_clients()
+        # Sentences are appended to one stream that the browser plays as it
+        # grows, or that is played as one clip at the end if it can't stream
+        if audio_server.streaming_available():
+            audio_url, player = audio_server.open_stream("audio/mpeg")
+        else:
+            audio_url, player = None, audio_server.AudioStream("audio/mpeg")
+        backend = pipeline.CloudBackend(
+            eleven_client,
+            stt_model,
+            llm_model,
+            voice_id,
+            tts_model,
+            speech_to_text=speech_backend(eleven_client),
+            player=player,
+        )
+        if audio_url:
+            st.audio(audio_url, autoplay=True)
+
+        st.subheader("Original Transcription")
+        transcript_placeholder = st.empty()
+        st.subheader("Processed Text")
+        text_placeholder = st.empty()
+
+        with st.spinner("Streaming audio..."):
+            try:
+                transcription, processed_text = pipeline.run_pipeline(
+                    pipeline.split_audio(uploaded_file),
+                    backend,
+                    fluent=fluent_option == "Fluent",
+                    on_transcript=transcript_placeholder.text,
+                    on_text=text_placeholder.text,
+                )
+            finally:
+                player.close()
+
+        if audio_url is None and player.getvalue():
+            st.audio(player.getvalue(), format="audio/mpeg", autoplay=True)
+
+        if transcription:
+            st.session_state["original_text"] = transcription
+            st.session_state["processed_text"] = processed_text
+
+        if show_latency:
+            tracing.latency_panel()
 
 with tab2:
     # Display original and processed text
@@ -216,6 +338,7 @@ with tab2:
         play_button = col2.button("Play Audio", type="primary")
 
         if play_button:
+            tracing.new_request()
             with st.spinner("Converting text to speech..."):
                 eleven_client = initialize_clients()
                 text_to_convert = (
@@ -224,12 +347,15 @@ with tab2:
                     else st.session_state["processed_text"]
                 )
 
-                audio_stream = text_to_speech(
+                audio_stream = utils.cached_text_to_speech(
                     text_to_convert, voice_id, tts_model, eleven_client
                 )
                 if audio_stream:
-                    # st.audio(audio_stream.content, format="audio/mp3")
-                    stream(audio_stream)
+                    # Played in the browser as the chunks arrive
+                    audio_server.play(audio_stream)
+
+            if show_latency:
+                tracing.latency_panel()
 
 # Footer
 st.markdown("---")
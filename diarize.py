@@ -0,0 +1,251 @@
+import numpy as np
+
+import long_audio
+import stt
+import tracing
+import utils
+import vad
+from cache import make_key
+
+# Speech is cut into windows of at most this length before clustering
+WINDOW_SECONDS = 1.5
+MIN_WINDOW_SECONDS = 0.3
+
+# Analysis frames, and log-spaced bands from 80 Hz to 7.6 kHz summarized
+# as cepstral coefficients (spectral shape, independent of loudness)
+FRAME_MS = 40
+HOP_MS = 10
+BANDS = 24
+CEPSTRA = 12
+
+# Pitch search range, and autocorrelation needed for a frame to count as voiced
+MIN_PITCH = 60
+MAX_PITCH = 400
+VOICING = 0.5
+
+# Clusters closer than this (relative to their spread) or holding less than
+# MIN_SHARE of the windows are treated as one speaker
+MIN_SEPARATION = 1.1
+MIN_SHARE = 0.1
+
+# Too few windows (about 15s of speech) to tell voices apart reliably
+MIN_WINDOWS = 10
+
+KMEANS_RESTARTS = 10
+KMEANS_ITERATIONS = 50
+
+_DCT = np.cos(
+    np.pi
+    / BANDS
+    * (np.arange(BANDS)[None, :] + 0.5)
+    * np.arange(1, CEPSTRA + 1)[:, None]
+)
+
+
+def _pitch(frames, rate):
+    shortest, longest = rate // MAX_PITCH, rate // MIN_PITCH
+    spectrum = np.fft.rfft(frames, n=2 * frames.shape[1], axis=1)
+    autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2, axis=1)[:, : longest + 1]
+    lag = shortest + autocorrelation[:, shortest:].argmax(axis=1)
+    peak = autocorrelation[np.arange(len(frames)), lag]
+    strength = peak / (autocorrelation[:, 0] + 1e-10)
+    return rate / lag, strength
+
+
+# Voice features of one window: mean cepstrum and median pitch of its voiced frames
+def window_features(samples, rate):
+    frame = rate * FRAME_MS // 1000
+    hop = rate * HOP_MS // 1000
+    if len(samples) < frame:
+        return None
+
+    starts = np.arange(0, len(samples) - frame + 1, hop)
+    frames = samples[starts[:, None] + np.arange(frame)].astype(np.float32) / 32768.0
+    frames *= np.hanning(frame)
+    power = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+
+    edges = np.geomspace(80, min(7600, rate / 2), BANDS + 1)
+    band = np.digitize(np.fft.rfftfreq(frame, 1 / rate), edges) - 1
+    energies = np.stack([power[:, band == b].sum(axis=1) for b in range(BANDS)], axis=1)
+    log_energies = np.log(energies + 1e-10)
+    cepstra = log_energies @ _DCT.T
+
+    pitch, strength = _pitch(frames, rate)
+    loudest = log_energies.max(axis=1)
+    voiced = (strength > VOICING) & (loudest > np.percentile(loudest, 30))
+    if voiced.sum() < 5:
+        voiced[:] = True
+    return np.concatenate(
+        [cepstra[voiced].mean(axis=0), [np.log(np.median(pitch[voiced]))]]
+    )
+
+
+# Speech windows as (start_sample, end_sample)
+def speech_windows(samples, rate):
+    window = int(WINDOW_SECONDS * rate)
+    minimum = int(MIN_WINDOW_SECONDS * rate)
+    windows = []
+    for start, end in vad.detect_speech(samples, rate):
+        for window_start in range(start, end, window):
+            window_end = min(window_start + window, end)
+            if window_end - window_start >= minimum:
+                windows.append((window_start, window_end))
+            elif windows and windows[-1][1] == window_start:
+                windows[-1] = (windows[-1][0], window_end)
+    return windows
+
+
+# Two-cluster k-means, best of several seeded restarts so results are
+# repeatable. Returns (labels, separation between the two centroids).
+def kmeans2(features):
+    rng = np.random.default_rng(0)
+    best = None
+    for _ in range(KMEANS_RESTARTS):
+        centroids = features[rng.choice(len(features), 2, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            distances = np.linalg.norm(features[:, None] - centroids[None], axis=2)
+            labels = distances.argmin(axis=1)
+            if labels.min() == labels.max():
+                break
+            updated = np.array([features[labels == k].mean(axis=0) for k in range(2)])
+            if np.allclose(updated, centroids):
+                break
+            centroids = updated
+        inertia = np.sum(distances[np.arange(len(features)), labels] ** 2)
+        if best is None or inertia < best[0]:
+            best = (inertia, labels, centroids)
+
+    inertia, labels, centroids = best
+    if labels.min() == labels.max():
+        return labels, 0.0
+    spread = np.sqrt(inertia / len(features)) + 1e-10
+    return labels, float(np.linalg.norm(centroids[0] - centroids[1]) / spread)
+
+
+# Majority vote with the neighbouring windows, so single stray windows
+# don't split a turn
+def _smooth(labels):
+    if len(labels) < 3:
+        return labels
+    padded = np.concatenate([labels[:1], labels, labels[-1:]])
+    return ((padded[:-2] + padded[1:-1] + padded[2:]) >= 2).astype(int)
+
+
+# Speaker turns from the audio alone, as (start_seconds, end_seconds, speaker_id).
+# The speaker_id is None everywhere unless two clearly distinct voices are found,
+# so too little audio is never mistaken for a single, already separated speaker.
+def local_segments(samples, rate):
+    windows = speech_windows(samples, rate)
+    features = [window_features(samples[start:end], rate) for start, end in windows]
+    kept = [(w, f) for w, f in zip(windows, features) if f is not None]
+    if not kept:
+        return []
+    windows = [w for w, _ in kept]
+    features = np.array([f for _, f in kept])
+
+    speakers = [None] * len(windows)
+    if len(windows) >= MIN_WINDOWS:
+        standardized = (features - features.mean(0)) / (features.std(0) + 1e-6)
+        clustered, separation = kmeans2(standardized)
+        share = min(np.mean(clustered == 0), np.mean(clustered == 1))
+        if separation >= MIN_SEPARATION and share >= MIN_SHARE:
+            speakers = [f"speaker_{label}" for label in _smooth(clustered)]
+
+    return [
+        (start / rate, end / rate, speaker)
+        for (start, end), speaker in zip(windows, speakers)
+    ]
+
+
+# Give each timed word the speaker of the local segment nearest its midpoint
+def label_words(words, segments):
+    if not segments:
+        return words
+    middles = np.array([(start + end) / 2 for start, end, _ in segments])
+    labelled = []
+    for word in words:
+        if word.get("start") is None:
+            labelled.append(word)
+            continue
+        middle = (word["start"] + word["end"]) / 2
+        inside = [s for s in segments if s[0] <= middle <= s[1]]
+        nearest = inside[0] if inside else segments[np.abs(middles - middle).argmin()]
+        speaker = nearest[2]
+        labelled.append({**word, "speaker_id": speaker})
+    return labelled
+
+
+# Group consecutive words by speaker into turns
+def turns_from_words(words):
+    turns = []
+    for word in words:
+        if word.get("type") == "spacing":
+            continue
+        speaker = word.get("speaker_id")
+        if not turns or turns[-1]["speaker"] != speaker:
+            turns.append({"speaker": speaker, "start": word.get("start"), "words": []})
+        turns[-1]["words"].append(word)
+        turns[-1]["end"] = word.get("end")
+    for turn in turns:
+        turn["text"] = long_audio.words_to_text(turn.pop("words"))
+    return turns
+
+
+# Speaker turns for timed words: the STT's own speaker labels when present,
+# otherwise local clustering of the audio the words were transcribed from.
+# Audio that can't be decoded here leaves the words as one speaker.
+def speaker_turns(words, audio=None):
+    if not any(w.get("speaker_id") for w in words) and audio is not None:
+        with tracing.span("local_diarization") as span:
+            try:
+                samples, rate = stt.load_pcm(audio)
+            except (ValueError, RuntimeError) as e:
+                span.record(error=str(e))
+            else:
+                segments = local_segments(samples, rate)
+                words = label_words(words, segments)
+                span.record(speakers=len({s[2] for s in segments if s[2]}))
+    return turns_from_words(words)
+
+
+# Seconds of speech per speaker
+def speaking_time(turns):
+    totals = {}
+    for turn in turns:
+        seconds = (turn["end"] or 0) - (turn["start"] or 0)
+        totals[turn["speaker"]] = totals.get(turn["speaker"], 0) + max(seconds, 0.01)
+    return totals
+
+
+# The patient is taken to be the dominant speaker (most speaking time) unless
+# chosen on the page, since an interviewer can talk more than the patient
+def patient_speaker(turns):
+    totals = speaking_time(turns)
+    return max(totals, key=totals.get) if totals else None
+
+
+# Text of one speaker's turns (the patient's by default). Returns
+# (text, speaker, speaker_count).
+def patient_text(turns, speaker=None):
+    speakers = {turn["speaker"] for turn in turns}
+    speaker = speaker if speaker is not None else patient_speaker(turns)
+    text = " ".join(turn["text"] for turn in turns if turn["speaker"] == speaker)
+    return text, speaker, len(speakers)
+
+
+# Transcribe with ElevenLabs speaker labels, cached like the other helpers.
+# Returns the timed words, or None.
+def cached_transcribe_words(audio, model_id, client, filename="audio"):
+    digest = utils.audio_digest(audio)
+    key = make_key("stt-words", digest, model_id, "diarize")
+    cached = utils.response_cache.get_json(key) if digest is not None else None
+    if cached is not None:
+        return cached["words"]
+
+    result = utils.speech_to_text(audio, model_id, client, filename, diarize=True)
+    if result is None:
+        return None
+    words = long_audio.result_words(result)
+    if digest is not None:
+        utils.response_cache.set_json(key, {"words": words})
+    return words
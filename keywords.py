@@ -0,0 +1,181 @@
+import re
+
+import numpy as np
+
+# Keyword labels, one per icon in icons/
+LABELS = ["cannot-talk", "explain", "food", "pain", "sleep"]
+
+# Weighted cue words and phrases for each label
+LEXICON = {
+    "pain": {
+        "pain": 2,
+        "painful": 2,
+        "hurt": 2,
+        "hurts": 2,
+        "hurting": 2,
+        "ache": 2,
+        "aches": 2,
+        "aching": 2,
+        "headache": 2,
+        "sore": 1.5,
+        "ouch": 1.5,
+        "ow": 1.5,
+        "bleeding": 1.5,
+        "injured": 1.5,
+        "burning": 1,
+        "sharp": 0.5,
+        "it hurts": 1,
+        "my head": 0.5,
+        "my chest": 1,
+        "my stomach": 0.5,
+    },
+    "food": {
+        "food": 2,
+        "hungry": 2,
+        "starving": 2,
+        "eat": 2,
+        "eating": 1.5,
+        "meal": 1.5,
+        "breakfast": 1.5,
+        "lunch": 1.5,
+        "dinner": 1.5,
+        "snack": 1.5,
+        "thirsty": 2,
+        "drink": 1.5,
+        "water": 1,
+        "coffee": 1,
+        "tea": 1,
+        "juice": 1,
+        "bread": 1,
+        "soup": 1,
+    },
+    "sleep": {
+        "sleep": 2,
+        "sleepy": 2,
+        "asleep": 1.5,
+        "tired": 2,
+        "exhausted": 2,
+        "rest": 1,
+        "nap": 2,
+        "bed": 1,
+        "lie down": 1.5,
+        "yawn": 1,
+        "night": 0.5,
+    },
+    "cannot-talk": {
+        "can't talk": 2,
+        "cannot talk": 2,
+        "can't speak": 2,
+        "cannot speak": 2,
+        "can't say": 2,
+        "cannot say": 2,
+        "the word": 1.5,
+        "words": 1,
+        "word": 1,
+        "stuck": 1,
+        "tongue": 1,
+        "talk": 0.5,
+        "speak": 0.5,
+    },
+    "explain": {
+        "explain": 2,
+        "clarify": 2,
+        "confused": 2,
+        "confusing": 2,
+        "understand": 1,
+        "don't understand": 2,
+        "what do you mean": 2,
+        "repeat": 1.5,
+        "again": 0.5,
+        "slowly": 1,
+        "mean": 0.5,
+    },
+}
+
+# Score a label needs to be selected; weaker evidence counts as low confidence.
+# Words that are often used in other senses ("the rest of", "went to bed",
+# "water") weigh less than this, so they alone go to the fallback.
+SELECT_SCORE = 1.5
+
+# A negation covers the rest of its clause: "I don't want to eat"
+_NEGATIONS = {
+    "no",
+    "not",
+    "don't",
+    "dont",
+    "doesn't",
+    "didn't",
+    "isn't",
+    "wasn't",
+    "aren't",
+    "haven't",
+    "won't",
+    "never",
+    "without",
+    "nothing",
+    "none",
+    "nor",
+}
+_CLAUSE_END = re.compile(r"[.,;:!?]|\b(?:but|and|because|though|although)\b")
+_TOKEN = re.compile(r"[a-z']+")
+
+# Vocabulary and (terms x labels) weight matrix for vectorized scoring
+_VOCAB = {}
+for _terms in LEXICON.values():
+    for _term in _terms:
+        _VOCAB.setdefault(_term, len(_VOCAB))
+_WEIGHTS = np.zeros((len(_VOCAB), len(LABELS)))
+for _label, _terms in LEXICON.items():
+    for _term, _weight in _terms.items():
+        _WEIGHTS[_VOCAB[_term], LABELS.index(_label)] = _weight
+_MAX_NGRAM = max(len(term.split()) for term in _VOCAB)
+
+
+def _clause_indices(tokens):
+    indices = []
+    negated = False
+    for i in range(len(tokens)):
+        for n in range(1, min(_MAX_NGRAM, len(tokens) - i) + 1):
+            term = " ".join(tokens[i : i + n])
+            # "no pain", "I don't have a headache": skip cues after a negation
+            if term in _VOCAB and not negated:
+                indices.append(_VOCAB[term])
+        negated = negated or tokens[i] in _NEGATIONS
+    return indices
+
+
+def _term_indices(text):
+    indices = []
+    for clause in _CLAUSE_END.split(text.lower().replace("’", "'")):
+        indices.extend(_clause_indices(_TOKEN.findall(clause)))
+    return indices
+
+
+# Per-label scores for a transcript
+def score(text):
+    counts = np.bincount(_term_indices(text), minlength=len(_VOCAB))
+    return dict(zip(LABELS, counts @ _WEIGHTS))
+
+
+# Returns (labels, confident). Confident when every cue is either strong
+# enough to select a label or absent altogether.
+def classify(text):
+    scores = score(text or "")
+    labels = [label for label in LABELS if scores[label] >= SELECT_SCORE]
+    weak = any(0 < s < SELECT_SCORE for s in scores.values())
+    return labels, not (weak and not labels)
+
+
+# Validate a free-form keyword string (e.g. from the LLM) into known labels
+def parse_labels(text):
+    found = set(re.findall(r"[a-z]+(?:-[a-z]+)?", (text or "").lower()))
+    return [label for label in LABELS if label in found]
+
+
+# Local classification, with an optional fallback (e.g. the LLM) for low-confidence cases
+def get_keywords(text, fallback=None):
+    labels, confident = classify(text)
+    if confident or fallback is None:
+        return labels
+    result = fallback(text)
+    return labels if result is None else parse_labels(result)
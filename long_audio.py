@@ -0,0 +1,184 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import stt
+import tracing
+import transcode
+import utils
+import vad
+from cache import make_key
+
+# Recordings are cut in pauses roughly every CHUNK_SECONDS, never more than
+# MAX_CHUNK_SECONDS apart. Anything longer than one chunk counts as long.
+CHUNK_SECONDS = 60
+MAX_CHUNK_SECONDS = 90
+
+# Pauses at least this long (seconds) are preferred as cut points
+MIN_PAUSE_SECONDS = 0.3
+
+# Audio shared by neighbouring chunks, so words at a cut are heard whole
+OVERLAP_SECONDS = 1.5
+
+# Chunks transcribed at once, across all sessions
+MAX_WORKERS = 4
+
+_chunk_executor = ThreadPoolExecutor(
+    max_workers=MAX_WORKERS, thread_name_prefix="stt-chunk"
+)
+
+
+# Cut points (sample indices, including 0 and the end) placed in pauses
+# between speech, as close to every chunk_seconds as the pauses allow
+def find_cuts(
+    samples, rate, chunk_seconds=CHUNK_SECONDS, max_chunk_seconds=MAX_CHUNK_SECONDS
+):
+    segments = vad.detect_speech(samples, rate)
+    pauses = [
+        ((end + start) // 2, start - end)
+        for (_, end), (start, _) in zip(segments, segments[1:])
+    ]
+
+    cuts = [0]
+    while len(samples) - cuts[-1] > max_chunk_seconds * rate:
+        target = cuts[-1] + chunk_seconds * rate
+        earliest = cuts[-1] + chunk_seconds * rate // 2
+        latest = cuts[-1] + max_chunk_seconds * rate
+        candidates = [(m, length) for m, length in pauses if earliest <= m <= latest]
+        if candidates:
+            middle, _ = min(
+                candidates,
+                key=lambda p: (p[1] < MIN_PAUSE_SECONDS * rate, abs(p[0] - target)),
+            )
+            cuts.append(middle)
+        else:
+            # No pause at all: cut mid-speech and rely on the overlap
+            cuts.append(target)
+    cuts.append(len(samples))
+    return cuts
+
+
+# Chunks as (start_sample, end_sample, own_start, own_end): the audio to send,
+# padded by the overlap, and the span (seconds) whose words the chunk keeps
+def plan_chunks(samples, rate, overlap_seconds=OVERLAP_SECONDS, **kwargs):
+    cuts = find_cuts(samples, rate, **kwargs)
+    overlap = int(overlap_seconds * rate)
+    return [
+        (
+            max(0, start - overlap),
+            min(len(samples), end + overlap),
+            start / rate,
+            end / rate,
+        )
+        for start, end in zip(cuts, cuts[1:])
+    ]
+
+
+def _encode(samples, rate):
+    if transcode.available():
+        return transcode.encode_pcm(samples, rate=rate)
+    return vad.write_wav(samples, rate), "wav"
+
+
+# Transcribe one chunk, returns its words with times in the whole recording
+def _transcribe_chunk(index, samples, rate, start, model_id, client):
+    data, extension = _encode(samples, rate)
+    result = utils.speech_to_text(
+        data, model_id, client, filename=f"chunk-{index}.{extension}"
+    )
+    if result is None:
+        return None
+
+    offset = start / rate
+    words = result_words(result, offset)
+    if not words and getattr(result, "text", None):
+        # No word timings: keep the whole text, placed mid-chunk
+        middle = round(offset + len(samples) / rate / 2, 3)
+        words = [{"text": result.text, "type": "word", "start": middle, "end": middle}]
+    return words
+
+
+# Words of a speech-to-text result as dicts, with times shifted by offset seconds
+def result_words(result, offset=0.0):
+    return [
+        {
+            "text": w.text,
+            "type": getattr(w, "type", "word"),
+            "start": None if w.start is None else round(offset + w.start, 3),
+            "end": None if w.end is None else round(offset + w.end, 3),
+            "speaker_id": getattr(w, "speaker_id", None),
+        }
+        for w in getattr(result, "words", None) or []
+    ]
+
+
+def words_to_text(words):
+    return " ".join(
+        w["text"].strip()
+        for w in words
+        if w.get("type", "word") != "spacing" and w["text"].strip()
+    )
+
+
+# Join chunk results, keeping each word only from the chunk that owns its
+# midpoint, so speech in the overlaps isn't repeated
+def stitch(chunks, results):
+    words = []
+    failed = []
+    for index, (chunk, chunk_words) in enumerate(zip(chunks, results)):
+        _, _, own_start, own_end = chunk
+        if chunk_words is None:
+            failed.append(index)
+            continue
+        last = index == len(chunks) - 1
+        for word in chunk_words:
+            if word["start"] is None or word["end"] is None:
+                continue
+            middle = (word["start"] + word["end"]) / 2
+            if own_start <= middle < own_end or (last and middle >= own_start):
+                words.append(word)
+    return words, failed
+
+
+# Transcribe a long recording as overlapping chunks in parallel.
+# Returns (text, words, failed_chunk_indices); word times are in the whole recording.
+def transcribe_long(audio, model_id, client, **kwargs):
+    with tracing.span("transcribe_long", model=model_id) as span:
+        samples, rate = stt.load_pcm(audio)
+        chunks = plan_chunks(samples, rate, **kwargs)
+        futures = [
+            utils.submit_to(
+                _chunk_executor,
+                _transcribe_chunk,
+                index,
+                samples[start:end],
+                rate,
+                start,
+                model_id,
+                client,
+            )
+            for index, (start, end, _, _) in enumerate(chunks)
+        ]
+        words, failed = stitch(chunks, [future.result() for future in futures])
+        text = words_to_text(words)
+        span.record(
+            chunks=len(chunks),
+            failed=len(failed),
+            seconds_audio=round(len(samples) / rate, 1),
+            bytes_out=tracing.payload_size(text),
+        )
+    return text, words, failed
+
+
+# Cached transcribe_long, keyed on the audio, model and chunking. Results with
+# failed chunks aren't cached, so a retry can fill the gaps.
+def cached_transcribe_long(audio, model_id, client):
+    key = make_key(
+        "stt-long", utils.audio_digest(audio), model_id, CHUNK_SECONDS, OVERLAP_SECONDS
+    )
+    cached = utils.response_cache.get_json(key)
+    if cached is not None:
+        return cached["text"], cached["words"], []
+
+    text, words, failed = transcribe_long(audio, model_id, client)
+    if text and not failed:
+        utils.response_cache.set_json(key, {"text": text, "words": words})
+    return text, words, failed
@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+import utils
+
+# Canonical phrase spoken for each keyword icon in icons/
+PHRASES = {
+    "pain": "I am in pain. I need help.",
+    "cannot-talk": "I'm having trouble speaking right now. Please be patient with me.",
+    "explain": "Can you please explain that again, slowly?",
+    "food": "I'm hungry. I would like something to eat.",
+    "sleep": "I'm tired. I would like to rest.",
+}
+
+# Most urgent first, when several keywords fire at once
+PRIORITY = list(PHRASES)
+
+
+# Phrases that failed to synthesize are tried again on a later run, at most
+# this often (seconds), so an outage doesn't slow every rerun
+RETRY_SECONDS = 60
+
+# ElevenLabs' default output is 128 kbps mp3, which gives a phrase's length
+MP3_BYTES_PER_SECOND = 128_000 // 8
+
+
+def _synthesize(phrase, voice_id, model_id, client):
+    try:
+        audio = utils.cached_text_to_speech(phrase, voice_id, model_id, client)
+        return b"".join(audio) if audio else None
+    except Exception as e:
+        # The stream broke off partway; nothing was cached, so a retry starts clean
+        print(f"Phrase synthesis error: {e}")
+        return None
+
+
+# Phrase audio kept in memory for the life of the process, keyed by keyword
+class PhraseBank(dict):
+    def __init__(self):
+        super().__init__()
+        self.attempted = None
+        self.lock = threading.Lock()
+
+    # Seconds until missing phrases may be synthesized again
+    def retry_wait(self):
+        if self.attempted is None:
+            return 0
+        return self.attempted + RETRY_SECONDS - time.monotonic()
+
+
+@st.cache_resource
+def _phrase_bank(voice_id, model_id):
+    return PhraseBank()
+
+
+# Synthesize the phrases once and keep the audio in memory. Only complete
+# phrases are kept; missing ones are retried on later runs. The mp3s are also
+# in the disk cache, so restarts don't re-call ElevenLabs.
+def load_phrase_bank(voice_id, model_id, client):
+    bank = _phrase_bank(voice_id, model_id)
+    missing = {k: p for k, p in PHRASES.items() if k not in bank}
+    if not missing or bank.retry_wait() > 0:
+        return bank
+    # Another session is already filling the bank; use what's there
+    if not bank.lock.acquire(blocking=False):
+        return bank
+
+    try:
+        bank.attempted = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+            futures = {
+                keyword: executor.submit(
+                    _synthesize, phrase, voice_id, model_id, client
+                )
+                for keyword, phrase in missing.items()
+            }
+        for keyword, future in futures.items():
+            if future.result():
+                bank[keyword] = future.result()
+    finally:
+        bank.lock.release()
+    return bank
+
+
+# Play the cached phrases for the keyword labels straight from memory, in
+# the browser, most urgent first. mp3 frames can be joined into one clip.
+# Returns how many seconds they take, so other audio can wait its turn.
+def play_keywords(phrase_bank, labels):
+    audio = b"".join(
+        phrase_bank[keyword]
+        for keyword in sorted(labels or [], key=PRIORITY.index)
+        if keyword in phrase_bank
+    )
+    if audio:
+        st.audio(audio, format="audio/mpeg", autoplay=True)
+    return len(audio) / MP3_BYTES_PER_SECOND
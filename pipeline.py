@@ -0,0 +1,226 @@
+import contextvars
+import io
+import queue
+import re
+import threading
+import wave
+
+from elevenlabs import stream
+from streamlit.runtime.scriptrunner import add_script_run_ctx
+
+import long_audio
+import stt
+import tracing
+import utils
+import vad
+
+# Audio is cut into segments for speech-to-text in pauses roughly every
+# SEGMENT_SECONDS, never more than MAX_SEGMENT_SECONDS apart
+SEGMENT_SECONDS = 5
+MAX_SEGMENT_SECONDS = 10
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_DONE = object()
+
+
+# Backend interface for the pipeline stages, so they can be swapped for local fakes
+class PipelineBackend:
+    def transcribe(self, segment):
+        raise NotImplementedError
+
+    def clean(self, text, fluent=False):
+        raise NotImplementedError
+
+    # Yield the cleaned text in pieces as it is generated. Backends without
+    # streaming fall back to a single piece.
+    def clean_stream(self, text, fluent=False):
+        cleaned = self.clean(text, fluent)
+        if cleaned:
+            yield cleaned
+
+    def synthesize(self, text):
+        raise NotImplementedError
+
+    def play(self, audio):
+        raise NotImplementedError
+
+
+# ElevenLabs speech-to-text / text-to-speech with OpenAI cleanup.
+# speech_to_text can be any stt.SpeechToText, e.g. an SttRouter that keeps
+# short segments on the local engine. With a player (an audio_server.AudioStream)
+# audio goes to the browser as one continuous stream instead of the speakers.
+class CloudBackend(PipelineBackend):
+    def __init__(
+        self,
+        client,
+        stt_model,
+        llm_model,
+        voice_id,
+        tts_model,
+        speech_to_text=None,
+        player=None,
+    ):
+        self.client = client
+        self.stt_model = stt_model
+        self.llm_model = llm_model
+        self.voice_id = voice_id
+        self.tts_model = tts_model
+        self.player = player
+        self.speech_to_text = speech_to_text or stt.ElevenLabsSTT(
+            client, stt_model, cached=False
+        )
+
+    def transcribe(self, segment):
+        return self.speech_to_text.transcribe(segment)
+
+    def clean(self, text, fluent=False):
+        return utils.process_with_openai(text, self.llm_model, fluent)
+
+    def clean_stream(self, text, fluent=False):
+        return utils.stream_process_with_openai(text, self.llm_model, fluent)
+
+    def synthesize(self, text):
+        return utils.text_to_speech(text, self.voice_id, self.tts_model, self.client)
+
+    def play(self, audio):
+        if self.player is not None:
+            self.player.extend(audio)
+        else:
+            stream(audio)
+
+
+# Split audio into in-memory mono WAV segments, cut in pauses between speech
+# so words and sentences stay whole. Non-WAV input is decoded with ffmpeg;
+# audio that can't be decoded is passed through whole.
+def split_audio(
+    audio, segment_seconds=SEGMENT_SECONDS, max_segment_seconds=MAX_SEGMENT_SECONDS
+):
+    try:
+        samples, rate = stt.load_pcm(audio)
+    except (ValueError, RuntimeError, wave.Error, EOFError):
+        if not isinstance(audio, str):
+            audio.seek(0)
+        yield audio
+        return
+
+    cuts = long_audio.find_cuts(samples, rate, segment_seconds, max_segment_seconds)
+    for index, (start, end) in enumerate(zip(cuts, cuts[1:])):
+        segment = io.BytesIO(vad.write_wav(samples[start:end], rate))
+        segment.name = f"segment-{index}.wav"
+        yield segment
+
+
+def split_sentences(text):
+    return [s.strip() for s in _SENTENCE_END.split(text) if s.strip()]
+
+
+# Assemble streamed text pieces into complete sentences
+def iter_sentences(pieces):
+    buffer = ""
+    for piece in pieces:
+        buffer += piece
+        parts = _SENTENCE_END.split(buffer)
+        for sentence in parts[:-1]:
+            if sentence.strip():
+                yield sentence.strip()
+        buffer = parts[-1]
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def _start_thread(target):
+    # Carry the tracing request id into the stage thread
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(target,), daemon=True)
+    # Let the stage threads report errors to the Streamlit page
+    add_script_run_ctx(thread)
+    thread.start()
+    return thread
+
+
+# Run speech-to-text, cleanup and text-to-speech as overlapping stages.
+# Each transcribed segment is cleaned as soon as it lands, and playback starts
+# on the first cleaned sentence while later segments are still in flight.
+def run_pipeline(segments, backend, fluent=False, on_transcript=None, on_text=None):
+    transcripts = (backend.transcribe(segment) for segment in segments)
+    return run_text_pipeline(transcripts, backend, fluent, on_transcript, on_text)
+
+
+# Same as run_pipeline, for sources that already produce text, such as
+# utils.RecognizerSession.transcripts() from the live microphone.
+# Cleanup is streamed: each finished sentence is handed to text-to-speech while
+# the rest is still generating, and on_text receives the text as it grows.
+def run_text_pipeline(
+    transcripts, backend, fluent=False, on_transcript=None, on_text=None
+):
+    pending = queue.Queue()
+    sentences = queue.Queue()
+    events = queue.Queue()
+    # The span's time to first byte is the time to first audio
+    span = tracing.Span("pipeline")
+
+    def transcribe_stage():
+        try:
+            for text in transcripts:
+                if text:
+                    pending.put(text)
+        finally:
+            pending.put(_DONE)
+
+    def clean_stage():
+        try:
+            while (text := pending.get()) is not _DONE:
+                events.put(("transcript", text))
+
+                def pieces():
+                    for piece in backend.clean_stream(text, fluent):
+                        events.put(("piece", piece))
+                        yield piece
+
+                for sentence in iter_sentences(pieces()):
+                    sentences.put(sentence)
+                    events.put(("sentence", sentence))
+        finally:
+            sentences.put(_DONE)
+            events.put((_DONE, None))
+
+    def speak_stage():
+        while (sentence := sentences.get()) is not _DONE:
+            audio = backend.synthesize(sentence)
+            if audio:
+                span.mark_first_byte()
+                backend.play(audio)
+
+    threads = [
+        _start_thread(transcribe_stage),
+        _start_thread(clean_stage),
+        _start_thread(speak_stage),
+    ]
+
+    # The calling thread only updates the page, so text keeps flowing during playback
+    transcript = []
+    cleaned = []
+    current = ""
+    while True:
+        kind, text = events.get()
+        if kind is _DONE:
+            break
+
+        if kind == "transcript":
+            transcript.append(text)
+            if on_transcript:
+                on_transcript(" ".join(transcript))
+        elif kind == "piece":
+            current += text
+            if on_text:
+                on_text(" ".join(cleaned + [current.strip()]))
+        else:
+            cleaned.append(text)
+            current = current.split(text, 1)[-1]
+
+    for thread in threads:
+        thread.join()
+
+    span.record(segments=len(transcript), sentences=len(cleaned))
+    span.end()
+    return " ".join(transcript), " ".join(cleaned)
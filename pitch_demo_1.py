@@ -2,8 +2,10 @@ import streamlit as st
 import os
 import tempfile
 import openai
-from elevenlabs import stream
-from elevenlabs.client import ElevenLabs
+import audio_server
+import clients
+import stt
+import utils
 
 # Set page configuration
 st.set_page_config(page_title="Speech Processing Demo", layout="wide")
@@ -12,7 +14,7 @@ st.set_page_config(page_title="Speech Processing Demo", layout="wide")
 # Setup clients
 elevenlabs_api_key = os.getenv("ELEVENLABS_API_KEY", "")
 openai_api_key = os.getenv("OPENAI_API_KEY", "")
-eleven_client = ElevenLabs(api_key=elevenlabs_api_key)
+eleven_client = clients.get_elevenlabs_client(elevenlabs_api_key)
 openai.api_key = openai_api_key
 
 # Use fixed models to avoid reloading
@@ -32,7 +34,7 @@ st.markdown(
 def initialize_clients():
     # ElevenLabs client
     if elevenlabs_api_key:
-        eleven_client = ElevenLabs(api_key=elevenlabs_api_key)
+        eleven_client = clients.get_elevenlabs_client(elevenlabs_api_key)
     else:
         st.error("Please provide your ElevenLabs API key")
         st.stop()
@@ -47,72 +49,6 @@ def initialize_clients():
     return eleven_client
 
 
-# Function for text-to-speech
-def text_to_speech(text, voice_id, model_id, client):
-    try:
-        audio_stream = client.text_to_speech.convert_as_stream(
-            text=text,
-            voice_id=voice_id,
-            model_id=model_id,
-        )
-        return audio_stream
-    except Exception as e:
-        st.error(f"Text-to-speech error: {e}")
-        return None
-
-
-# Function for speech-to-text
-def speech_to_text(file_data, model_id, client):
-    try:
-        result = client.speech_to_text.convert(
-            model_id=model_id,
-            file=file_data,
-        )
-        return result
-    except Exception as e:
-        st.error(f"Speech-to-text error: {e}")
-        return None
-
-
-# Function to process text with OpenAI
-def process_with_openai(text, model, fluent=False):
-    if not fluent:
-        prompt = "You are a helpful assistant that cleans up transcribed speech. Remove filler words like 'um', 'uh', 'like', etc. Fix grammar issues. Just output the text as-is with no headings or styling."
-    else:
-        prompt = """
-        I'll give you some conversations or monologue from aphasia patients. For each piece of text, do the following:
-        Check if there's more than one person talking. If so, only keep the words of aphasia patients.
-        Determine whether it's Broca's aphasia or Wernicke's aphasia:
-        For Broca's aphasia, make the words into grammarly correct, coherent, concise sentences that fully covers what they’re trying to say.
-        For Wernicke's aphasia, guess what is the actual meaning of the patient, and turn that into logical, meaningful sentences that others could understand.
-        Generate the output with only the converted text and nothing else.    
-        """
-
-    try:
-        response = openai.chat.completions.create(
-            model=model,
-            messages=[
-                {
-                    "role": "system",
-                    "content": prompt,
-                },
-                {
-                    "role": "user",
-                    "content": f"Clean up and summarize this transcribed speech: {text}",
-                },
-            ],
-            temperature=0.3,
-            max_tokens=1024,
-        )
-
-        # Extract the content from the response
-        cleaned_text = response.choices[0].message.content
-        return cleaned_text
-    except Exception as e:
-        st.error(f"OpenAI API error: {e}")
-        return None
-
-
 # Main app layout
 tab1, tab2 = st.tabs(["Demo", ""])
 
@@ -136,8 +72,9 @@ with tab1:
             # Speech to text
             st.info("Converting speech to text...")
 
-            file_data = open("audio/aphasia-1-speaker.mp3", "rb")
-            transcription = speech_to_text(file_data, stt_model, eleven_client)
+            transcription = stt.ElevenLabsSTT(eleven_client, stt_model).transcribe(
+                "audio/aphasia-1-speaker.mp3"
+            )
 
             if transcription:
                 st.session_state["original_text"] = transcription
@@ -146,7 +83,7 @@ with tab1:
                 st.info("Processing text with AI...")
                 fluent_bool = fluent_option == "Fluent"
                 print("Using", fluent_bool)
-                processed_text = process_with_openai(
+                processed_text = utils.cached_process_with_openai(
                     transcription, llm_model, fluent_bool
                 )
 
@@ -160,12 +97,12 @@ with tab1:
                     eleven_client = initialize_clients()
                     text_to_convert = processed_text
 
-                    audio_stream = text_to_speech(
+                    audio_stream = utils.cached_text_to_speech(
                         text_to_convert, voice_id, tts_model, eleven_client
                     )
                     if audio_stream:
-                        # st.audio(audio_stream.content, format="audio/mp3")
-                        stream(audio_stream)
+                        # Played in the browser as the chunks arrive
+                        audio_server.play(audio_stream)
 
 
 # Footer
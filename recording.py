@@ -1,20 +1,18 @@
 from pvrecorder import PvRecorder
-import wave
-import struct
+from capture import FRAME_LENGTH, WavStreamWriter, new_recording_path
 
-recorder = PvRecorder(device_index=-1, frame_length=512)
-audio = []
+recorder = PvRecorder(device_index=-1, frame_length=FRAME_LENGTH)
+writer = WavStreamWriter(new_recording_path())
 
 try:
     recorder.start()
 
     while True:
         frame = recorder.read()
-        audio.extend(frame)
+        writer.write(frame)
 except KeyboardInterrupt:
     recorder.stop()
-    with wave.open("audio/test.mp3", "w") as f:
-        f.setparams((1, 2, 16000, 512, "NONE", "NONE"))
-        f.writeframes(struct.pack("h" * len(audio), *audio))
 finally:
+    writer.close()
     recorder.delete()
+    print("Audio saved as", writer.path)
@@ -0,0 +1,193 @@
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import openai
+
+# Responses worth retrying: timeouts, conflicts, rate limits and server errors
+RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+RETRIES = 3
+BASE_DELAY = 0.5
+MAX_DELAY = 8
+
+# Optional rate limiters by provider name, anything with a blocking wait().
+# Each attempt waits its turn, so retries are paced like any other request.
+LIMITERS = {}
+
+# Consecutive failures before a provider is cut off, and how long until it is retried
+FAILURE_THRESHOLD = 5
+RESET_AFTER = 30
+
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="hedge")
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Stops calling a provider after repeated failures, then lets a single trial
+# request through once RESET_AFTER has passed
+class CircuitBreaker:
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_after=RESET_AFTER):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider):
+    with _breakers_lock:
+        return _breakers.setdefault(provider, CircuitBreaker())
+
+
+def status_code(error):
+    code = getattr(error, "status_code", None)
+    if code is None:
+        code = getattr(getattr(error, "response", None), "status_code", None)
+    return code
+
+
+def is_retryable(error):
+    if isinstance(
+        error, (httpx.TransportError, openai.APIConnectionError, TimeoutError)
+    ):
+        return True
+    return status_code(error) in RETRY_STATUSES
+
+
+def _retry_after(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+# Call fn(timeout) for a provider within an overall deadline, retrying
+# transient failures with exponential backoff and full jitter
+def call(provider, fn, deadline, retries=None):
+    if retries is None:
+        retries = RETRIES
+    breaker = get_breaker(provider)
+    started = time.monotonic()
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            raise CircuitOpenError(f"{provider} is temporarily unavailable")
+
+        limiter = LIMITERS.get(provider)
+        if limiter is not None:
+            limiter.wait()
+        remaining = deadline - (time.monotonic() - started)
+        if remaining <= 0:
+            raise TimeoutError(f"{provider} deadline of {deadline}s exceeded")
+
+        try:
+            result = fn(remaining)
+        except Exception as e:
+            if not is_retryable(e):
+                # The provider answered, the request itself was bad
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+
+            delay = _retry_after(e) or random.uniform(
+                0, min(MAX_DELAY, BASE_DELAY * 2**attempt)
+            )
+            remaining = deadline - (time.monotonic() - started)
+            if attempt >= retries or delay >= remaining:
+                raise
+            time.sleep(delay)
+            attempt += 1
+            continue
+
+        breaker.record_success()
+        return result
+
+
+# Run fn(timeout), and if it hasn't returned after hedge_after seconds start a
+# second identical request; whichever finishes first wins
+def hedged(fn, hedge_after, deadline):
+    started = time.monotonic()
+    futures = [_hedge_executor.submit(fn, deadline)]
+    done, _ = wait(futures, timeout=hedge_after)
+    if not done:
+        futures.append(_hedge_executor.submit(fn, deadline - hedge_after))
+
+    errors = []
+    pending = set(futures)
+    while pending:
+        remaining = deadline - (time.monotonic() - started)
+        done, pending = wait(
+            pending, timeout=max(remaining, 0), return_when=FIRST_COMPLETED
+        )
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.add_done_callback(_discard)
+                return future.result()
+            errors.append(future.exception())
+
+    for future in pending:
+        future.add_done_callback(_discard)
+    if errors:
+        raise errors[0]
+    raise TimeoutError(f"no response within {deadline}s")
+
+
+def _discard(future):
+    if future.exception() is None and hasattr(future.result(), "close"):
+        future.result().close()
+
+
+# Start a lazy stream and wait for its first chunk, so a hedged or retried
+# request only counts as done once data is actually flowing
+def prime(chunks):
+    chunks = iter(chunks)
+    try:
+        first = next(chunks)
+    except StopIteration:
+        return iter(())
+
+    def resumed():
+        try:
+            yield first
+            yield from chunks
+        finally:
+            if hasattr(chunks, "close"):
+                chunks.close()
+
+    return resumed()
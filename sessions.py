@@ -0,0 +1,163 @@
+import os
+import queue
+import threading
+import time
+import uuid
+
+import streamlit as st
+from pvrecorder import PvRecorder
+
+from capture import FRAME_LENGTH, WavStreamWriter, new_recording_path
+
+SESSIONS_DIR = os.path.join("audio", "sessions")
+
+# Limits that keep many simultaneous recordings bounded. Audio goes straight
+# to disk, so memory doesn't grow with length; the time limit only guards
+# against recordings that were never stopped.
+MAX_SESSIONS = 48
+MAX_SECONDS = 3 * 60 * 60
+QUEUE_FRAMES = 64
+
+_STOP = object()
+
+
+# One clinician's recording: a capture thread reads the microphone into a
+# bounded queue and a writer thread streams it to the session's own WAV file.
+# Nothing here touches st.session_state, so it is safe to run outside the script thread.
+class RecordingSession:
+    def __init__(
+        self, session_id, directory=SESSIONS_DIR, max_seconds=MAX_SECONDS, owner=None
+    ):
+        self.id = session_id
+        self.owner = owner
+        self.path = new_recording_path(os.path.join(directory, session_id))
+        self.max_seconds = max_seconds
+        self.started = time.time()
+        self.seconds = 0.0
+        self.dropped_frames = 0
+        self.limit_reached = False
+        self.error = None
+        self._frames = queue.Queue(maxsize=QUEUE_FRAMES)
+        self._stop = threading.Event()
+        self._capture = threading.Thread(
+            target=self._capture_loop, name=f"capture-{session_id}", daemon=True
+        )
+        self._writer = threading.Thread(
+            target=self._write_loop, name=f"writer-{session_id}", daemon=True
+        )
+
+    @property
+    def running(self):
+        return self._writer.is_alive()
+
+    def start(self):
+        self._writer.start()
+        self._capture.start()
+
+    def stop(self, timeout=5):
+        self._stop.set()
+        self._capture.join(timeout)
+        self._writer.join(timeout)
+
+    def _capture_loop(self):
+        try:
+            recorder = PvRecorder(device_index=-1, frame_length=FRAME_LENGTH)
+        except Exception as e:
+            self.error = str(e)
+            self._send_stop()
+            return
+
+        try:
+            recorder.start()
+            while not self._stop.is_set():
+                frame = recorder.read()
+                try:
+                    self._frames.put_nowait(frame)
+                except queue.Full:
+                    # Disk can't keep up; drop rather than grow without bound
+                    self.dropped_frames += 1
+            recorder.stop()
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            recorder.delete()
+            self._send_stop()
+
+    # Tell the writer to finish. Never blocks for long: if the queue stays full
+    # (the writer died or is stuck), the oldest frames make room for the marker.
+    def _send_stop(self, timeout=1):
+        try:
+            self._frames.put(_STOP, timeout=timeout)
+            return
+        except queue.Full:
+            pass
+        while True:
+            try:
+                self._frames.put_nowait(_STOP)
+                return
+            except queue.Full:
+                try:
+                    self._frames.get_nowait()
+                    self.dropped_frames += 1
+                except queue.Empty:
+                    pass
+
+    def _write_loop(self):
+        try:
+            with WavStreamWriter(self.path) as writer:
+                while (frame := self._frames.get()) is not _STOP:
+                    writer.write(frame)
+                    self.seconds = writer.seconds
+                    if self.seconds >= self.max_seconds:
+                        self.limit_reached = True
+                        self._stop.set()
+        except Exception as e:
+            self.error = str(e)
+            self._stop.set()
+
+
+# Tracks recording sessions for every user of the server
+class SessionManager:
+    def __init__(self, max_sessions=MAX_SESSIONS):
+        self.max_sessions = max_sessions
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    # owner identifies the browser session; each may only record once at a time
+    def start(self, owner=None):
+        with self._lock:
+            # Forget sessions that finished long ago but were never stopped
+            for session_id, session in list(self._sessions.items()):
+                expired = time.time() - session.started > 2 * session.max_seconds
+                if expired and not session.running:
+                    del self._sessions[session_id]
+            if owner is not None and any(
+                s.owner == owner and s.running for s in self._sessions.values()
+            ):
+                raise RuntimeError("A recording is already in progress")
+            active = sum(s.running for s in self._sessions.values())
+            if active >= self.max_sessions:
+                raise RuntimeError(
+                    f"Too many recordings in progress ({active}), try again shortly"
+                )
+            session = RecordingSession(uuid.uuid4().hex[:12], owner=owner)
+            self._sessions[session.id] = session
+            # Started under the lock so a second start sees it as running
+            session.start()
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            return self._sessions.get(session_id)
+
+    def stop(self, session_id):
+        with self._lock:
+            session = self._sessions.pop(session_id, None)
+        if session:
+            session.stop()
+        return session
+
+
+@st.cache_resource
+def get_session_manager():
+    return SessionManager()
@@ -0,0 +1,239 @@
+import io
+import os
+import threading
+import wave
+
+import azure.cognitiveservices.speech as speechsdk
+import numpy as np
+import streamlit as st
+
+import clients
+import tracing
+import transcode
+import utils
+import vad
+
+# Optional on-device engine: pip install faster-whisper
+try:
+    from faster_whisper import WhisperModel
+except ImportError:
+    WhisperModel = None
+
+LOCAL_MODEL = os.getenv("APHASIANET_LOCAL_STT_MODEL", "tiny.en")
+
+# Clips up to this long are transcribed locally, where skipping the upload
+# beats the cloud model's speed; longer clips go to the cloud
+LOCAL_MAX_SECONDS = 8
+LOCAL_MAX_IN_FLIGHT = 1
+
+# Rough size of a second of compressed upload (128 kbps mp3), for clip length
+COMPRESSED_BYTES_PER_SECOND = 16000
+
+# Local transcriptions share the CPU across all sessions
+_local_slots = threading.BoundedSemaphore(LOCAL_MAX_IN_FLIGHT)
+
+# Longest wait for Azure to finish recognizing an uploaded clip
+AZURE_TIMEOUT = 120
+
+
+# Decode audio (path, bytes, memoryview or file) to int16 mono samples and rate.
+# 16-bit WAV is read directly; other formats need ffmpeg. Raises ValueError
+# when the audio can't be decoded here, and RuntimeError when ffmpeg fails.
+def load_pcm(audio):
+    if isinstance(audio, str):
+        with open(audio, "rb") as f:
+            data = f.read()
+    elif hasattr(audio, "read"):
+        position = audio.tell()
+        data = audio.read()
+        audio.seek(position)
+    else:
+        data = audio
+
+    try:
+        return vad.read_wav(io.BytesIO(data))
+    except (ValueError, wave.Error, EOFError):
+        if not transcode.available():
+            raise ValueError("Decoding this audio requires ffmpeg")
+        return transcode.decode_pcm(data), transcode.TARGET_RATE
+
+
+# Length of a clip in seconds, from the WAV header or estimated from its size.
+# None for streamed input, whose length isn't known up front.
+def clip_seconds(audio):
+    if isinstance(audio, str):
+        source, size = audio, os.path.getsize(audio)
+    elif isinstance(audio, (bytes, bytearray, memoryview)):
+        source, size = io.BytesIO(audio), tracing.payload_size(audio)
+    elif hasattr(audio, "read"):
+        source, size = audio, tracing.payload_size(audio)
+    else:
+        return None
+
+    position = source.tell() if hasattr(source, "tell") else None
+    try:
+        with wave.open(source, "rb") as f:
+            return f.getnframes() / f.getframerate()
+    except (wave.Error, EOFError):
+        return size / COMPRESSED_BYTES_PER_SECOND
+    finally:
+        if position is not None:
+            source.seek(position)
+
+
+# Backend interface for speech-to-text engines. transcribe() takes a path,
+# in-memory buffer or open file and returns the transcript text, or None.
+class SpeechToText:
+    name = "stt"
+
+    def available(self):
+        return True
+
+    def transcribe(self, audio, filename="audio"):
+        raise NotImplementedError
+
+
+# ElevenLabs Scribe, through the cached and retried helpers in utils
+class ElevenLabsSTT(SpeechToText):
+    name = "elevenlabs"
+
+    def __init__(self, client, model_id="scribe_v1", cached=True):
+        self.client = client
+        self.model_id = model_id
+        self.cached = cached
+
+    def transcribe(self, audio, filename="audio"):
+        if self.cached:
+            return utils.cached_speech_to_text(
+                audio, self.model_id, self.client, filename
+            )
+        result = utils.speech_to_text(audio, self.model_id, self.client, filename)
+        return getattr(result, "text", result)
+
+
+# Azure Speech. Without audio it listens on the microphone through the shared
+# recognizer session; clips are pushed to a one-off recognizer as PCM.
+class AzureSTT(SpeechToText):
+    name = "azure"
+
+    def __init__(self, language="en-US"):
+        self.language = language
+
+    def transcribe(self, audio=None, filename="audio"):
+        if audio is None:
+            return utils.recognize_from_microphone()
+
+        span = tracing.Span(
+            "azure_speech_to_text", bytes_in=tracing.payload_size(audio)
+        )
+        try:
+            samples, rate = load_pcm(audio)
+            stream_format = speechsdk.audio.AudioStreamFormat(
+                samples_per_second=rate, bits_per_sample=16, channels=1
+            )
+            push_stream = speechsdk.audio.PushAudioInputStream(
+                stream_format=stream_format
+            )
+            push_stream.write(samples.astype("<i2", copy=False).tobytes())
+            push_stream.close()
+
+            recognizer = speechsdk.SpeechRecognizer(
+                speech_config=clients.get_speech_config(self.language),
+                audio_config=speechsdk.audio.AudioConfig(stream=push_stream),
+            )
+            texts = []
+            done = threading.Event()
+
+            def on_recognized(evt):
+                if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
+                    texts.append(evt.result.text)
+
+            recognizer.recognized.connect(on_recognized)
+            recognizer.session_stopped.connect(lambda evt: done.set())
+            recognizer.canceled.connect(lambda evt: done.set())
+            recognizer.start_continuous_recognition_async().get()
+            done.wait(AZURE_TIMEOUT)
+            recognizer.stop_continuous_recognition_async().get()
+
+            text = " ".join(t for t in texts if t) or None
+            span.record(bytes_out=tracing.payload_size(text))
+            span.end()
+            return text
+        except Exception as e:
+            span.end(error=e)
+            st.error(f"Speech-to-text error: {e}")
+            return None
+
+
+@st.cache_resource
+def _load_whisper(model_name):
+    return WhisperModel(model_name, device="cpu", compute_type="int8")
+
+
+# Offline transcription on the CPU with a small Whisper model
+class LocalSTT(SpeechToText):
+    name = "local"
+
+    def __init__(self, model_name=LOCAL_MODEL):
+        self.model_name = model_name
+
+    def available(self):
+        return WhisperModel is not None
+
+    def transcribe(self, audio, filename="audio"):
+        span = tracing.Span(
+            "local_speech_to_text",
+            model=self.model_name,
+            bytes_in=tracing.payload_size(audio),
+        )
+        try:
+            samples, rate = load_pcm(audio)
+            if rate != transcode.TARGET_RATE:
+                positions = np.arange(0, len(samples), rate / transcode.TARGET_RATE)
+                samples = np.interp(positions, np.arange(len(samples)), samples)
+            segments, _ = _load_whisper(self.model_name).transcribe(
+                samples.astype(np.float32) / 32768.0,
+                beam_size=1,
+                condition_on_previous_text=False,
+            )
+            text = " ".join(s.text.strip() for s in segments if s.text.strip()) or None
+            span.record(bytes_out=tracing.payload_size(text))
+            span.end()
+            return text
+        except Exception as e:
+            span.end(error=e)
+            st.warning(f"Local speech-to-text error: {e}")
+            return None
+
+
+# Sends short clips to the local engine while it has capacity, and everything
+# else (or anything the local engine fails on) to the cloud. Pass seconds when
+# the clip's length is known, e.g. from transcode.prepare_upload, since the
+# estimate from a compressed clip's size can be far off.
+class SttRouter(SpeechToText):
+    name = "router"
+
+    def __init__(self, cloud, local=None, max_local_seconds=LOCAL_MAX_SECONDS):
+        self.cloud = cloud
+        self.local = local if local is not None and local.available() else None
+        self.max_local_seconds = max_local_seconds
+
+    def _use_local(self, audio, seconds=None):
+        if self.local is None:
+            return False
+        if seconds is None:
+            seconds = clip_seconds(audio)
+        if seconds is None or seconds > self.max_local_seconds:
+            return False
+        # Don't queue behind a busy CPU; the cloud absorbs the overflow
+        return _local_slots.acquire(blocking=False)
+
+    def transcribe(self, audio, filename="audio", seconds=None):
+        if self._use_local(audio, seconds):
+            try:
+                text = self.local.transcribe(audio, filename)
+            finally:
+                _local_slots.release()
+            if text:
+                return text
+        return self.cloud.transcribe(audio, filename)
@@ -0,0 +1,245 @@
+import atexit
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import streamlit as st
+
+TRACE_DIR = os.getenv("APHASIANET_TRACE_DIR", os.path.join(".cache", "traces"))
+TRACE_FILE = os.getenv("APHASIANET_TRACE_FILE", os.path.join(TRACE_DIR, "traces.jsonl"))
+METRICS_FILE = os.getenv(
+    "APHASIANET_METRICS_FILE", os.path.join(TRACE_DIR, "metrics.prom")
+)
+
+# Spans are written to disk by a background thread; the Prometheus file is
+# rewritten at most this often (seconds), and on flush() or exit
+METRICS_INTERVAL = 15
+
+_request_id = contextvars.ContextVar("request_id", default=None)
+_lock = threading.Lock()
+_recent = deque(maxlen=1000)
+_totals = defaultdict(lambda: defaultdict(float))
+_pending = queue.Queue()
+_exporter = None
+_metrics_changed = False
+
+
+# Start a new traced request; spans recorded in this context are tagged with its id
+def new_request():
+    request_id = uuid.uuid4().hex[:12]
+    _request_id.set(request_id)
+    return request_id
+
+
+def current_request():
+    return _request_id.get()
+
+
+# Timing for one pipeline stage: wall time, time to first byte, bytes and tokens
+class Span:
+    def __init__(self, stage, **fields):
+        self.stage = stage
+        self.fields = fields
+        self.request_id = _request_id.get()
+        self.started = time.perf_counter()
+        self.first_byte = None
+        self._ended = False
+
+    def record(self, **fields):
+        self.fields.update(fields)
+
+    def mark_first_byte(self):
+        if self.first_byte is None:
+            self.first_byte = time.perf_counter() - self.started
+
+    def end(self, error=None):
+        if self._ended:
+            return
+        self._ended = True
+        entry = {
+            "time": time.time(),
+            "request_id": self.request_id,
+            "stage": self.stage,
+            "seconds": round(time.perf_counter() - self.started, 4),
+            "ttfb": None if self.first_byte is None else round(self.first_byte, 4),
+            **self.fields,
+        }
+        if error:
+            entry["error"] = str(error)
+        _export(entry)
+
+
+@contextmanager
+def span(stage, **fields):
+    current = Span(stage, **fields)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(error=repr(e))
+        raise
+    current.end(error=current.fields.pop("error", None))
+
+
+# Wrap a streamed response so the span records time to first byte and bytes out
+def traced_stream(current, chunks):
+    total = 0
+    try:
+        for chunk in chunks:
+            current.mark_first_byte()
+            total += len(chunk)
+            yield chunk
+    except Exception as e:
+        current.end(error=repr(e))
+        raise
+    finally:
+        current.record(bytes_out=total)
+        current.end()
+
+
+# Size of a payload (text, bytes, path or file object) for bytes in/out
+def payload_size(payload):
+    if payload is None:
+        return 0
+    if isinstance(payload, str):
+        return len(payload.encode("utf-8"))
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        return len(payload)
+    if hasattr(payload, "getbuffer"):
+        return payload.getbuffer().nbytes
+    try:
+        return os.fstat(payload.fileno()).st_size
+    except (AttributeError, OSError, ValueError):
+        return 0
+
+
+def _export(entry):
+    global _exporter, _metrics_changed
+    with _lock:
+        _recent.append(entry)
+        totals = _totals[entry["stage"]]
+        totals["count"] += 1
+        totals["seconds"] += entry["seconds"]
+        totals["errors"] += "error" in entry
+        for field in ("bytes_in", "bytes_out", "prompt_tokens", "completion_tokens"):
+            totals[field] += entry.get(field) or 0
+        _metrics_changed = True
+
+        if _exporter is None:
+            _exporter = threading.Thread(
+                target=_export_loop, name="trace-export", daemon=True
+            )
+            _exporter.start()
+    _pending.put(entry)
+
+
+def _write_entries(entries):
+    if os.path.dirname(TRACE_FILE):
+        os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+    with open(TRACE_FILE, "a", encoding="utf-8") as f:
+        f.writelines(json.dumps(entry) + "\n" for entry in entries)
+
+
+# Appends queued spans to the trace file in batches, and refreshes the
+# Prometheus file every METRICS_INTERVAL seconds while spans keep coming
+def _export_loop():
+    last_metrics = time.monotonic()
+    while True:
+        try:
+            entries = [_pending.get(timeout=METRICS_INTERVAL)]
+        except queue.Empty:
+            entries = []
+        while True:
+            try:
+                entries.append(_pending.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            if entries:
+                _write_entries(entries)
+            if time.monotonic() - last_metrics >= METRICS_INTERVAL:
+                write_metrics()
+                last_metrics = time.monotonic()
+        except OSError as e:
+            print(f"Trace export error: {e}")
+        finally:
+            for _ in entries:
+                _pending.task_done()
+
+
+# Wait until every recorded span is on disk, then refresh the Prometheus file
+def flush():
+    _pending.join()
+    write_metrics()
+
+
+# Totals per stage in Prometheus text exposition format, written to
+# METRICS_FILE when anything changed since the last write, or to path
+def write_metrics(path=None):
+    global _metrics_changed
+    metrics = [
+        ("seconds", "aphasianet_stage_seconds_sum", "counter"),
+        ("count", "aphasianet_stage_seconds_count", "counter"),
+        ("errors", "aphasianet_stage_errors_total", "counter"),
+        ("bytes_in", "aphasianet_stage_bytes_in_total", "counter"),
+        ("bytes_out", "aphasianet_stage_bytes_out_total", "counter"),
+        ("prompt_tokens", "aphasianet_stage_prompt_tokens_total", "counter"),
+        ("completion_tokens", "aphasianet_stage_completion_tokens_total", "counter"),
+    ]
+    with _lock:
+        if path is None:
+            if not _metrics_changed:
+                return
+            path = METRICS_FILE
+            _metrics_changed = False
+        lines = []
+        for field, name, kind in metrics:
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, totals in sorted(_totals.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {totals[field]:g}')
+
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+
+atexit.register(flush)
+
+
+def request_spans(request_id=None):
+    request_id = request_id or _request_id.get()
+    with _lock:
+        return [e for e in _recent if e["request_id"] == request_id]
+
+
+# Per-request latency breakdown for the Streamlit apps
+def latency_panel(request_id=None):
+    spans = request_spans(request_id)
+    if not spans:
+        return
+    with st.expander("Latency breakdown"):
+        st.table(
+            [
+                {
+                    "Stage": e["stage"],
+                    "Seconds": e["seconds"],
+                    "First byte": e["ttfb"],
+                    "Bytes in": e.get("bytes_in"),
+                    "Bytes out": e.get("bytes_out"),
+                    "Tokens": (e.get("prompt_tokens") or 0)
+                    + (e.get("completion_tokens") or 0),
+                    "Error": e.get("error", ""),
+                }
+                for e in spans
+            ]
+        )
+        st.caption(f"Total: {sum(e['seconds'] for e in spans):.2f}s")
@@ -0,0 +1,140 @@
+import shutil
+import subprocess
+import threading
+import time
+
+import numpy as np
+
+# Speech-to-text models work at 16 kHz mono; anything more is wasted upload
+TARGET_RATE = 16000
+
+CHUNK_SIZE = 64 * 1024
+
+# ffmpeg output arguments and file extension per codec. Opus at its lowest
+# complexity is barely larger and encodes several times faster.
+CODECS = {
+    "opus": (
+        [
+            "-c:a",
+            "libopus",
+            "-b:a",
+            "24k",
+            "-application",
+            "voip",
+            "-compression_level",
+            "0",
+            "-f",
+            "ogg",
+        ],
+        "ogg",
+    ),
+    "flac": (["-c:a", "flac", "-f", "flac"], "flac"),
+}
+
+
+def available():
+    return shutil.which("ffmpeg") is not None
+
+
+def _chunks(data):
+    view = memoryview(data)
+    for i in range(0, len(view), CHUNK_SIZE):
+        yield view[i : i + CHUNK_SIZE]
+
+
+# Pipe chunks through ffmpeg, yielding output as soon as it is produced.
+# Input is fed from a separate thread so encoding overlaps with reading.
+def _run_ffmpeg(input_args, output_args, chunks):
+    process = subprocess.Popen(
+        ["ffmpeg", "-hide_banner", "-loglevel", "error", *input_args, "-i", "pipe:0"]
+        + output_args
+        + ["pipe:1"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    def feed():
+        try:
+            for chunk in chunks:
+                process.stdin.write(chunk)
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    feeder.start()
+    try:
+        while chunk := process.stdout.read(CHUNK_SIZE):
+            yield chunk
+    finally:
+        feeder.join()
+        stderr = process.stderr.read().decode(errors="replace")
+        if process.wait() != 0:
+            raise RuntimeError(f"ffmpeg failed: {stderr.strip()}")
+
+
+# Decode any input audio to int16 mono samples at the given rate
+def decode_pcm(data, rate=TARGET_RATE):
+    pcm = b"".join(
+        _run_ffmpeg([], ["-ac", "1", "-ar", str(rate), "-f", "s16le"], _chunks(data))
+    )
+    return np.frombuffer(pcm, dtype="<i2")
+
+
+# Encode int16 mono samples, returns (encoded_bytes, extension)
+def encode_pcm(samples, codec="opus", rate=TARGET_RATE):
+    output_args, extension = CODECS[codec]
+    input_args = ["-f", "s16le", "-ar", str(rate), "-ac", "1"]
+    data = samples.astype("<i2", copy=False).tobytes()
+    return b"".join(_run_ffmpeg(input_args, output_args, _chunks(data))), extension
+
+
+# Size and time savings for one file, and the length of the audio it holds
+# (None when it couldn't be decoded)
+def stats(input_bytes, output_bytes, seconds, duration=None):
+    return {
+        "input_kb": round(input_bytes / 1024, 1),
+        "output_kb": round(output_bytes / 1024, 1),
+        "ratio": round(input_bytes / max(output_bytes, 1), 2),
+        "seconds": round(seconds, 3),
+        "duration": duration,
+    }
+
+
+# Downmix, resample, optionally trim silence, and compress audio before upload.
+# Returns (bytes, extension, stats, trim_timestamps); passes audio through
+# unchanged when ffmpeg isn't installed or can't decode it.
+def prepare_upload(data, extension, codec="opus", trim=None):
+    started = time.perf_counter()
+    if not available():
+        return data, extension, stats(len(data), len(data), 0), []
+
+    try:
+        samples = decode_pcm(data)
+    except RuntimeError as e:
+        # Corrupt or unsupported here; the STT provider may still manage
+        print(f"Upload transcode skipped: {e}")
+        return data, extension, stats(len(data), len(data), 0), []
+    original_duration = len(samples) / TARGET_RATE
+    timestamps = []
+    if trim:
+        trimmed, timestamps = trim(samples, TARGET_RATE)
+        if timestamps:
+            samples = trimmed
+    duration = len(samples) / TARGET_RATE
+    try:
+        encoded, encoded_extension = encode_pcm(samples, codec)
+    except RuntimeError as e:
+        print(f"Upload transcode skipped: {e}")
+        encoded, encoded_extension = data, extension
+    if len(encoded) >= len(data):
+        encoded, encoded_extension, timestamps = data, extension, []
+        duration = original_duration
+    return (
+        encoded,
+        encoded_extension,
+        stats(len(data), len(encoded), time.perf_counter() - started, duration),
+        timestamps,
+    )
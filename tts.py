@@ -0,0 +1,151 @@
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import tracing
+import utils
+
+# Cloud audio that hasn't started within this many seconds is replaced by the local voice
+LATENCY_BUDGET = 2.0
+
+# Utterances this short are spoken locally when short_local is on, since a
+# local engine answers before a network round trip would
+SHORT_UTTERANCE_WORDS = 4
+
+LOCAL_VOICE = "en-us"
+LOCAL_WORDS_PER_MINUTE = 150
+
+CHUNK_SIZE = 16 * 1024
+
+# Cloud requests waited on at once, across all sessions. Kept off the LLM pool
+# so slow speech can't hold up cleanup, or the other way round.
+MAX_WORKERS = 16
+
+_tts_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="tts")
+
+
+# Backend interface for text-to-speech engines. synthesize() returns an
+# iterator of audio chunks in the engine's format (mp3 or wav), or None on failure.
+class TextToSpeech:
+    name = "tts"
+    format = "mp3"
+
+    def available(self):
+        return True
+
+    def synthesize(self, text):
+        raise NotImplementedError
+
+
+# ElevenLabs streaming synthesis, through the retried and hedged helpers in utils
+class ElevenLabsTTS(TextToSpeech):
+    name = "elevenlabs"
+    format = "mp3"
+
+    def __init__(self, client, voice_id, model_id, cached=True):
+        self.client = client
+        self.voice_id = voice_id
+        self.model_id = model_id
+        self.cached = cached
+
+    def synthesize(self, text):
+        if self.cached:
+            return utils.cached_text_to_speech(
+                text, self.voice_id, self.model_id, self.client
+            )
+        return utils.text_to_speech(text, self.voice_id, self.model_id, self.client)
+
+
+# Offline synthesis on the CPU with eSpeak NG, streamed as WAV
+class LocalTTS(TextToSpeech):
+    name = "local"
+    format = "wav"
+
+    def __init__(self, voice=LOCAL_VOICE, words_per_minute=LOCAL_WORDS_PER_MINUTE):
+        self.voice = voice
+        self.words_per_minute = words_per_minute
+
+    def _executable(self):
+        return shutil.which("espeak-ng") or shutil.which("espeak")
+
+    def available(self):
+        return self._executable() is not None
+
+    def synthesize(self, text):
+        if not self.available():
+            return None
+        span = tracing.Span(
+            "local_text_to_speech",
+            model=self.voice,
+            bytes_in=tracing.payload_size(text),
+        )
+        # Text goes in on stdin, so text starting with "-" isn't read as an option
+        process = subprocess.Popen(
+            [
+                self._executable(),
+                "--stdout",
+                "--stdin",
+                "-v",
+                self.voice,
+                "-s",
+                str(self.words_per_minute),
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            # A few KB at most, well within the pipe buffer
+            process.stdin.write(text.encode("utf-8"))
+        except BrokenPipeError:
+            pass
+        finally:
+            process.stdin.close()
+
+        def chunks():
+            try:
+                while chunk := process.stdout.read(CHUNK_SIZE):
+                    yield chunk
+            finally:
+                process.stdout.close()
+                process.wait()
+
+        return tracing.traced_stream(span, chunks())
+
+
+# Cloud voice with a local fallback: if the cloud fails, or hasn't produced
+# audio within the latency budget, the local engine speaks instead.
+class FallbackTTS(TextToSpeech):
+    name = "fallback"
+
+    def __init__(
+        self, primary, fallback, latency_budget=LATENCY_BUDGET, short_local=False
+    ):
+        self.primary = primary
+        self.fallback = fallback
+        self.latency_budget = latency_budget
+        self.short_local = short_local
+
+    def _is_short(self, text):
+        return len(text.split()) <= SHORT_UTTERANCE_WORDS
+
+    def synthesize(self, text):
+        use_fallback = self.fallback.available()
+        if use_fallback and self.short_local and self._is_short(text):
+            return self.fallback.synthesize(text)
+
+        future = utils.submit_to(_tts_executor, self.primary.synthesize, text)
+        try:
+            audio = future.result(timeout=self.latency_budget if use_fallback else None)
+        except TimeoutError:
+            # Stop the late cloud stream once it turns up
+            future.add_done_callback(_close_result)
+            audio = None
+        if audio is not None or not use_fallback:
+            return audio
+        return self.fallback.synthesize(text)
+
+
+def _close_result(future):
+    if future.exception() is None and hasattr(future.result(), "close"):
+        future.result().close()
@@ -1,53 +1,329 @@
 import os
+import contextlib
+import contextvars
+import math
+import hashlib
+import io
+import json
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 import azure.cognitiveservices.speech as speechsdk
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import openai
+from cache import DiskCache, make_key
+import clients
+import keywords
+import resilience
+import tracing
 
+# Temperature used for all OpenAI cleanup calls (part of the cache key)
+LLM_TEMPERATURE = 0.3
 
-# Function for speech-to-text
-def speech_to_text(file_path, model_id, client):
+# Per-call deadline for OpenAI requests, in seconds (including retries)
+LLM_TIMEOUT = 30
+
+# Deadlines for ElevenLabs requests
+STT_TIMEOUT = 60
+TTS_TIMEOUT = 20
+
+# Seconds to wait for the first TTS audio before sending a duplicate request.
+# ElevenLabs bills every request, so hedging is off (None) unless
+# APHASIANET_TTS_HEDGE_AFTER is set.
+TTS_HEDGE_AFTER = (
+    float(os.environ["APHASIANET_TTS_HEDGE_AFTER"])
+    if os.getenv("APHASIANET_TTS_HEDGE_AFTER")
+    else None
+)
+
+response_cache = DiskCache()
+
+# Shared pool for running independent LLM calls concurrently
+_llm_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm")
+
+
+# Errors shown by the helpers, kept for callers outside Streamlit (see collect_errors)
+_error_log = contextvars.ContextVar("error_log", default=None)
+
+
+# Collect the messages of errors shown inside the block, including those from
+# helpers run through submit(), e.g. to record why a batch file failed
+@contextlib.contextmanager
+def collect_errors():
+    errors = []
+    token = _error_log.set(errors)
     try:
-        with open(file_path, "rb") as file_data:
-            result = client.speech_to_text.convert(
-                model_id=model_id,
-                file=file_data,
-            )
+        yield errors
+    finally:
+        _error_log.reset(token)
+
+
+# Show an error on the page, and keep it for collect_errors()
+def show_error(message):
+    errors = _error_log.get()
+    if errors is not None:
+        errors.append(message)
+    st.error(message)
+
+
+# Pooled OpenAI client for the key set by the page (openai.api_key) or the environment
+def _openai():
+    return clients.get_openai_client(openai.api_key)
+
+
+# Chat completion retried with backoff until the overall timeout runs out
+def chat(timeout, **kwargs):
+    return resilience.call(
+        "openai",
+        lambda remaining: _openai().chat.completions.create(
+            timeout=remaining, **kwargs
+        ),
+        timeout,
+    )
+
+
+# Token usage of an OpenAI response, for tracing
+def token_usage(response):
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return {}
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+    }
+
+
+# Read-only file view over an in-memory buffer, without copying it
+class _BufferReader(io.RawIOBase):
+    def __init__(self, buffer):
+        self._view = memoryview(buffer).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._pos, io.SEEK_END: len(self._view)}
+        self._pos = max(0, base[whence] + offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def readinto(self, b):
+        chunk = self._view[self._pos : self._pos + len(b)]
+        b[: len(chunk)] = chunk
+        self._pos += len(chunk)
+        return len(chunk)
+
+
+# File view over an iterator of byte chunks, uploaded as they are produced
+class _IterReader(io.RawIOBase):
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self._pending:
+            self._pending = next(self._chunks, None)
+            if self._pending is None:
+                self._pending = b""
+                return 0
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+
+# Wrap audio (bytes, memoryview, open file or iterator of chunks) for upload
+def _audio_file(audio, filename):
+    if isinstance(audio, (bytes, bytearray, memoryview)):
+        return (filename, _BufferReader(audio))
+    if hasattr(audio, "read"):
+        return (os.path.basename(getattr(audio, "name", "") or filename), audio)
+    return (filename, _IterReader(audio))
+
+
+# ElevenLabs per-attempt options: the remaining deadline, and no SDK retries
+def _request_options(timeout):
+    return {"timeout_in_seconds": max(1, math.ceil(timeout)), "max_retries": 0}
+
+
+# Function for speech-to-text. Accepts a file path, an in-memory buffer,
+# an open file or an iterator of byte chunks. Extra options (e.g. diarize=True)
+# are passed to the ElevenLabs request.
+def speech_to_text(file_path, model_id, client, filename="audio", **options):
+    span = tracing.Span(
+        "speech_to_text",
+        model=model_id,
+        bytes_in=(
+            os.path.getsize(file_path)
+            if isinstance(file_path, str)
+            else tracing.payload_size(file_path)
+        ),
+    )
+    # Iterators can only be uploaded once; open files are rewound between attempts
+    retries = resilience.RETRIES
+    position = None
+    if hasattr(file_path, "read"):
+        if file_path.seekable():
+            position = file_path.tell()
+        else:
+            retries = 0
+    elif not isinstance(file_path, (str, bytes, bytearray, memoryview)):
+        retries = 0
+
+    def upload(timeout):
+        if isinstance(file_path, str):
+            with open(file_path, "rb") as file_data:
+                return client.speech_to_text.convert(
+                    model_id=model_id,
+                    file=file_data,
+                    request_options=_request_options(timeout),
+                    **options,
+                )
+        if position is not None:
+            file_path.seek(position)
+        return client.speech_to_text.convert(
+            model_id=model_id,
+            file=_audio_file(file_path, filename),
+            request_options=_request_options(timeout),
+            **options,
+        )
+
+    try:
+        result = resilience.call("elevenlabs_stt", upload, STT_TIMEOUT, retries=retries)
+        span.record(bytes_out=tracing.payload_size(getattr(result, "text", None)))
+        span.end()
         return result
     except Exception as e:
-        st.error(f"Speech-to-text error: {e}")
+        span.end(error=e)
+        show_error(f"Speech-to-text error: {e}")
         return None
 
 
-# Function to process text with OpenAI
-def process_with_openai(text, model):
+CLEANUP_PROMPT = "You are a helpful assistant that cleans up transcribed speech. Remove filler words like 'um', 'uh', 'like', etc. Fix grammar issues. Just output the text as-is with no headings or styling."
+
+FLUENT_PROMPT = """
+I'll give you some conversations or monologue from aphasia patients. For each piece of text, do the following:
+Check if there's more than one person talking. If so, only keep the words of aphasia patients.
+Determine whether it's Broca's aphasia or Wernicke's aphasia:
+For Broca's aphasia, make the words into grammarly correct, coherent, concise sentences that fully covers what they’re trying to say.
+For Wernicke's aphasia, guess what is the actual meaning of the patient, and turn that into logical, meaningful sentences that others could understand.
+Generate the output with only the converted text and nothing else.
+"""
+
+# Fluent prompt for transcripts already filtered to the patient's speech
+FLUENT_DIARIZED_PROMPT = """
+I'll give you a monologue from an aphasia patient. Determine whether it's Broca's aphasia or Wernicke's aphasia:
+For Broca's aphasia, make the words into grammarly correct, coherent, concise sentences that fully covers what they’re trying to say.
+For Wernicke's aphasia, guess what is the actual meaning of the patient, and turn that into logical, meaningful sentences that others could understand.
+Generate the output with only the converted text and nothing else.
+"""
+
+
+def cleanup_prompt(fluent, diarized=False):
+    if not fluent:
+        return CLEANUP_PROMPT
+    return FLUENT_DIARIZED_PROMPT if diarized else FLUENT_PROMPT
+
+
+# Function to process text with OpenAI. diarized means the text is already
+# only the patient's speech, so the fluent prompt can skip speaker filtering.
+def process_with_openai(text, model, fluent=False, timeout=LLM_TIMEOUT, diarized=False):
+    prompt = cleanup_prompt(fluent, diarized)
+    span = tracing.Span(
+        "process_with_openai", model=model, bytes_in=tracing.payload_size(text)
+    )
+
     try:
-        response = openai.chat.completions.create(
+        response = chat(
+            timeout,
             model=model,
             messages=[
                 {
                     "role": "system",
-                    "content": "You are a helpful assistant that cleans up transcribed speech. Remove filler words like 'um', 'uh', 'like', etc. Fix grammar issues. Just output the text as-is with no headings or styling.",
+                    "content": prompt,
                 },
                 {
                     "role": "user",
                     "content": f"Clean up and summarize this transcribed speech: {text}",
                 },
             ],
-            temperature=0.3,
+            temperature=LLM_TEMPERATURE,
             max_tokens=1024,
         )
 
         # Extract the content from the response
         cleaned_text = response.choices[0].message.content
+        span.record(
+            bytes_out=tracing.payload_size(cleaned_text), **token_usage(response)
+        )
+        span.end()
         return cleaned_text
     except Exception as e:
-        st.error(f"OpenAI API error: {e}")
+        span.end(error=e)
+        show_error(f"OpenAI API error: {e}")
         return None
 
 
-def get_keywords_openai(text, model):
+# Streaming variant of process_with_openai, yields the cleaned text as it is generated
+def stream_process_with_openai(text, model, fluent=False, timeout=LLM_TIMEOUT):
+    prompt = cleanup_prompt(fluent)
+    span = tracing.Span(
+        "stream_process_with_openai", model=model, bytes_in=tracing.payload_size(text)
+    )
+
     try:
-        response = openai.chat.completions.create(
+        response = chat(
+            timeout,
+            model=model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": prompt,
+                },
+                {
+                    "role": "user",
+                    "content": f"Clean up and summarize this transcribed speech: {text}",
+                },
+            ],
+            temperature=LLM_TEMPERATURE,
+            max_tokens=1024,
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+
+        total = 0
+        for chunk in response:
+            if chunk.usage:
+                span.record(**token_usage(chunk))
+            if chunk.choices and chunk.choices[0].delta.content:
+                span.mark_first_byte()
+                piece = chunk.choices[0].delta.content
+                total += tracing.payload_size(piece)
+                yield piece
+        span.record(bytes_out=total)
+        span.end()
+    except Exception as e:
+        span.end(error=e)
+        show_error(f"OpenAI API error: {e}")
+
+
+def get_keywords_openai(text, model, timeout=LLM_TIMEOUT):
+    span = tracing.Span(
+        "get_keywords_openai", model=model, bytes_in=tracing.payload_size(text)
+    )
+    try:
+        response = chat(
+            timeout,
             model=model,
             messages=[
                 {
@@ -59,61 +335,343 @@ def get_keywords_openai(text, model):
                     "content": f"Find the keywords in the text: {text}",
                 },
             ],
-            temperature=0.3,
+            temperature=LLM_TEMPERATURE,
             max_tokens=1024,
         )
 
         # Extract the content from the response
         cleaned_text = response.choices[0].message.content
+        span.record(
+            bytes_out=tracing.payload_size(cleaned_text), **token_usage(response)
+        )
+        span.end()
         return cleaned_text
     except Exception as e:
-        st.error(f"OpenAI API error: {e}")
+        span.end(error=e)
+        show_error(f"OpenAI API error: {e}")
         return None
 
 
+# Run a helper on the shared LLM pool, keeping the Streamlit context so st.error still works
+def submit(fn, *args, **kwargs):
+    return submit_to(_llm_executor, fn, *args, **kwargs)
+
+
+# Same as submit, on another pool
+def submit_to(executor, fn, *args, **kwargs):
+    ctx = get_script_run_ctx()
+    context = contextvars.copy_context()
+
+    def run():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        return fn(*args, **kwargs)
+
+    return executor.submit(context.run, run)
+
+
+# Result of a submitted LLM call, or None (with the error shown) if it timed out
+def wait_result(future, timeout, name):
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        show_error(f"OpenAI API error: {name} timed out after {timeout}s")
+        return None
+
+
+# Clean up the text while picking keywords, returns (processed_text, keyword_labels).
+# Keywords come from the local classifier, with the LLM only consulted (concurrently
+# with cleanup) when it is unsure. on_keywords is called as soon as they are known.
+def process_and_get_keywords(
+    text, model, fluent=False, timeout=LLM_TIMEOUT, on_keywords=None
+):
+    processed = submit(process_with_openai, text, model, fluent, timeout)
+
+    def llm_fallback(text):
+        return wait_result(
+            submit(get_keywords_openai, text, model, timeout),
+            timeout,
+            "keyword extraction",
+        )
+
+    with tracing.span("classify_keywords", bytes_in=tracing.payload_size(text)):
+        labels = keywords.get_keywords(text, fallback=llm_fallback)
+    if on_keywords and labels:
+        on_keywords(labels)
+    return wait_result(processed, timeout, "cleanup"), labels
+
+
+# Single structured-output call returning both the cleaned text and the keywords
+def process_and_get_keywords_combined(text, model, fluent=False, timeout=LLM_TIMEOUT):
+    prompt = cleanup_prompt(fluent)
+    schema = {
+        "type": "object",
+        "properties": {
+            "cleaned_text": {"type": "string"},
+            "keywords": {
+                "type": "array",
+                "items": {"type": "string", "enum": keywords.LABELS},
+            },
+        },
+        "required": ["cleaned_text", "keywords"],
+        "additionalProperties": False,
+    }
+    span = tracing.Span(
+        "process_and_get_keywords_combined",
+        model=model,
+        bytes_in=tracing.payload_size(text),
+    )
+
+    try:
+        response = chat(
+            timeout,
+            model=model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": prompt
+                    + f" Also pick the relevant keywords (if any) for the transcript, choosing only between {', '.join(keywords.LABELS)}.",
+                },
+                {
+                    "role": "user",
+                    "content": f"Clean up and summarize this transcribed speech: {text}",
+                },
+            ],
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "cleanup_and_keywords",
+                    "strict": True,
+                    "schema": schema,
+                },
+            },
+            temperature=LLM_TEMPERATURE,
+            max_tokens=1024,
+        )
+
+        content = response.choices[0].message.content
+        span.record(bytes_out=tracing.payload_size(content), **token_usage(response))
+        span.end()
+        result = json.loads(content)
+        return result["cleaned_text"], keywords.parse_labels(
+            ",".join(result["keywords"])
+        )
+    except Exception as e:
+        span.end(error=e)
+        show_error(f"OpenAI API error: {e}")
+        return None, None
+
+
 # Function for text-to-speech
 def text_to_speech(text, voice_id, model_id, client):
-    try:
-        audio_stream = client.text_to_speech.convert_as_stream(
-            text=text,
-            voice_id=voice_id,
-            model_id=model_id,
+    span = tracing.Span(
+        "text_to_speech", model=model_id, bytes_in=tracing.payload_size(text)
+    )
+
+    # An attempt only counts as done once the first audio chunk arrives,
+    # so a stalled request is retried or hedged before anything plays
+    def request(timeout):
+        return resilience.prime(
+            client.text_to_speech.convert_as_stream(
+                text=text,
+                voice_id=voice_id,
+                model_id=model_id,
+                request_options=_request_options(timeout),
+            )
         )
-        return audio_stream
+
+    def attempt(timeout):
+        if TTS_HEDGE_AFTER is None:
+            return request(timeout)
+        return resilience.hedged(request, TTS_HEDGE_AFTER, timeout)
+
+    try:
+        audio_stream = resilience.call("elevenlabs_tts", attempt, TTS_TIMEOUT)
+        span.mark_first_byte()
+        # Bytes out are recorded as the audio streams
+        return tracing.traced_stream(span, audio_stream)
     except Exception as e:
-        st.error(f"Text-to-speech error: {e}")
+        span.end(error=e)
+        show_error(f"Text-to-speech error: {e}")
         return None
 
 
-# Recognize from the microphone
-def recognize_from_microphone():
-    # This example requires environment variables named "SPEECH_KEY" and "SPEECH_REGION"
-    speech_config = speechsdk.SpeechConfig(
-        subscription=os.environ.get("SPEECH_KEY"),
-        region=os.environ.get("SPEECH_REGION"),
-    )
-    speech_config.speech_recognition_language = "en-US"
+# Hash of the audio for cache keys, or None for one-shot iterators
+def audio_digest(audio):
+    digest = hashlib.sha256()
+    if isinstance(audio, str):
+        with open(audio, "rb") as f:
+            while chunk := f.read(1024 * 1024):
+                digest.update(chunk)
+    elif isinstance(audio, (bytes, bytearray, memoryview)):
+        digest.update(audio)
+    elif hasattr(audio, "getbuffer"):
+        with audio.getbuffer() as view:
+            digest.update(view)
+    elif hasattr(audio, "read"):
+        position = audio.tell()
+        while chunk := audio.read(1024 * 1024):
+            digest.update(chunk)
+        audio.seek(position)
+    else:
+        return None
+    return digest.digest()
+
+
+# Hash chunks of a streamed upload as they pass through
+def _hashed_chunks(chunks, digest):
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+# Cached speech-to-text, keyed on the audio and model. Returns the transcript text.
+def cached_speech_to_text(file_path, model_id, client, filename="audio"):
+    digest = audio_digest(file_path)
+    if digest is not None:
+        key = make_key("stt", digest, model_id)
+        cached = response_cache.get_json(key)
+        if cached is not None:
+            return cached["text"]
+    else:
+        # Streamed input: hash it on the way through and cache afterwards
+        streamed_digest = hashlib.sha256()
+        file_path = _hashed_chunks(file_path, streamed_digest)
+
+    result = speech_to_text(file_path, model_id, client, filename)
+    if result is None:
+        return None
+    text = getattr(result, "text", result)
+    if digest is None:
+        key = make_key("stt", streamed_digest.digest(), model_id)
+    response_cache.set_json(key, {"text": text})
+    return text
 
-    audio_config = speechsdk.audio.AudioConfig(use_default_microphone=True)
-    speech_recognizer = speechsdk.SpeechRecognizer(
-        speech_config=speech_config, audio_config=audio_config
+
+# Cached OpenAI cleanup, keyed on the text, model, prompt and temperature
+def cached_process_with_openai(text, model, fluent=False, diarized=False):
+    key = make_key(
+        "llm", text, model, cleanup_prompt(fluent, diarized), LLM_TEMPERATURE
     )
+    cached = response_cache.get_json(key)
+    if cached is not None:
+        return cached["text"]
 
-    print("Speak into your microphone.")
-    speech_recognition_result = speech_recognizer.recognize_once_async().get()
+    cleaned_text = process_with_openai(text, model, fluent, diarized=diarized)
+    if cleaned_text is not None:
+        response_cache.set_json(key, {"text": cleaned_text})
+    return cleaned_text
 
-    if speech_recognition_result.reason == speechsdk.ResultReason.RecognizedSpeech:
-        print("Recognized: {}".format(speech_recognition_result.text))
-        return speech_recognition_result.text
-    elif speech_recognition_result.reason == speechsdk.ResultReason.NoMatch:
-        print(
-            "No speech could be recognized: {}".format(
-                speech_recognition_result.no_match_details
-            )
+
+# Cached text-to-speech. Audio is stored as an mp3 file and replayed from disk.
+def cached_text_to_speech(text, voice_id, model_id, client):
+    key = make_key("tts", text, voice_id, model_id)
+    path = response_cache.get_path(key, ".mp3")
+    if path is not None:
+        return response_cache.read_chunks(path)
+
+    audio_stream = text_to_speech(text, voice_id, model_id, client)
+    if audio_stream is None:
+        return None
+    return response_cache.tee_chunks(key, ".mp3", audio_stream)
+
+
+# Silence (ms) before Azure closes an utterance, long enough for aphasic hesitations
+SEGMENTATION_SILENCE_MS = 2000
+
+# Seconds to wait for speech to start, and of quiet after speech before a turn ends
+START_SILENCE_SECONDS = 10
+END_SILENCE_SECONDS = 4
+
+
+# Long-lived continuous recognizer. Setup happens once and the session is
+# reused across button presses; results arrive through event callbacks.
+class RecognizerSession:
+    def __init__(self, language="en-US"):
+        speech_config = clients.get_speech_config(language)
+        speech_config.set_property(
+            speechsdk.PropertyId.Speech_SegmentationSilenceTimeoutMs,
+            str(SEGMENTATION_SILENCE_MS),
+        )
+
+        audio_config = speechsdk.audio.AudioConfig(use_default_microphone=True)
+        self.recognizer = speechsdk.SpeechRecognizer(
+            speech_config=speech_config, audio_config=audio_config
+        )
+
+        self._events = queue.Queue()
+        self._lock = threading.Lock()
+        self.recognizer.recognizing.connect(self._on_recognizing)
+        self.recognizer.recognized.connect(self._on_recognized)
+        self.recognizer.canceled.connect(self._on_canceled)
+        self.recognizer.session_stopped.connect(
+            lambda evt: self._events.put(("stopped", None))
         )
-    elif speech_recognition_result.reason == speechsdk.ResultReason.Canceled:
-        cancellation_details = speech_recognition_result.cancellation_details
+
+    def _on_recognizing(self, evt):
+        self._events.put(("partial", evt.result.text))
+
+    def _on_recognized(self, evt):
+        if evt.result.reason == speechsdk.ResultReason.RecognizedSpeech:
+            if evt.result.text:
+                print("Recognized: {}".format(evt.result.text))
+                self._events.put(("final", evt.result.text))
+        elif evt.result.reason == speechsdk.ResultReason.NoMatch:
+            print(
+                "No speech could be recognized: {}".format(evt.result.no_match_details)
+            )
+
+    def _on_canceled(self, evt):
+        cancellation_details = evt.cancellation_details
         print("Speech Recognition canceled: {}".format(cancellation_details.reason))
         if cancellation_details.reason == speechsdk.CancellationReason.Error:
             print("Error details: {}".format(cancellation_details.error_details))
             print("Did you set the speech resource key and region values?")
+        self._events.put(("stopped", None))
+
+    # Yield ("partial", text) hypotheses and ("final", text) utterances
+    # until the speaker has been quiet for end_silence seconds.
+    def listen(
+        self, start_silence=START_SILENCE_SECONDS, end_silence=END_SILENCE_SECONDS
+    ):
+        with self._lock:
+            while not self._events.empty():
+                self._events.get_nowait()
+
+            print("Speak into your microphone.")
+            self.recognizer.start_continuous_recognition_async().get()
+            try:
+                timeout = start_silence
+                while True:
+                    try:
+                        kind, text = self._events.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                    if kind == "stopped":
+                        break
+                    timeout = end_silence
+                    yield kind, text
+            finally:
+                self.recognizer.stop_continuous_recognition_async().get()
+
+    # Only the final utterances, for stages that consume whole sentences
+    def transcripts(self, **kwargs):
+        for kind, text in self.listen(**kwargs):
+            if kind == "final":
+                yield text
+
+    def recognize(self, **kwargs):
+        text = " ".join(self.transcripts(**kwargs))
+        return text or None
+
+
+@st.cache_resource
+def get_recognizer_session():
+    return RecognizerSession()
+
+
+# Recognize from the microphone
+def recognize_from_microphone():
+    with tracing.span("recognize_from_microphone") as span:
+        text = get_recognizer_session().recognize()
+        span.record(bytes_out=tracing.payload_size(text))
+    return text
@@ -0,0 +1,132 @@
+import io
+import wave
+
+import numpy as np
+
+# Analysis frame length
+FRAME_MS = 30
+
+# Speech must be this much louder than the estimated noise floor (dB)
+ENERGY_MARGIN_DB = 12
+MIN_THRESHOLD_DBFS = -55
+
+# Quieter frames still count as speech if they look like fricatives (high zero-crossing rate)
+ZCR_THRESHOLD = 0.25
+
+# Padding kept around speech, and shortest burst treated as speech
+HANGOVER_MS = 240
+MIN_SPEECH_MS = 90
+
+# Internal pauses longer than this are shortened to this length
+MAX_PAUSE_MS = 500
+
+
+def _frames(samples, frame_len):
+    count = len(samples) // frame_len
+    return samples[: count * frame_len].reshape(count, frame_len)
+
+
+# Per-frame energy (dBFS) and zero-crossing rate
+def frame_features(samples, rate, frame_ms=FRAME_MS):
+    frames = _frames(samples.astype(np.float32) / 32768.0, rate * frame_ms // 1000)
+    energy = 10 * np.log10(np.mean(frames**2, axis=1) + 1e-10)
+    zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+    return energy, zcr
+
+
+def _runs(mask):
+    edges = np.diff(np.concatenate(([0], mask.astype(np.int8), [0])))
+    return np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+
+
+# Detect speech in int16 mono samples, returns a list of (start, end) sample indices
+def detect_speech(samples, rate, frame_ms=FRAME_MS):
+    if len(samples) < rate * frame_ms // 1000:
+        return []
+
+    energy, zcr = frame_features(samples, rate, frame_ms)
+    threshold = max(np.percentile(energy, 10) + ENERGY_MARGIN_DB, MIN_THRESHOLD_DBFS)
+    speech = (energy > threshold) | (
+        (energy > threshold - ENERGY_MARGIN_DB / 2) & (zcr > ZCR_THRESHOLD)
+    )
+
+    # Drop isolated clicks, then pad what's left so word edges aren't clipped
+    starts, ends = _runs(speech)
+    min_frames = max(1, MIN_SPEECH_MS // frame_ms)
+    for start, end in zip(starts, ends):
+        if end - start < min_frames:
+            speech[start:end] = False
+
+    hangover = HANGOVER_MS // frame_ms
+    if hangover:
+        speech = np.convolve(speech, np.ones(2 * hangover + 1), mode="same") > 0
+
+    frame_len = rate * frame_ms // 1000
+    starts, ends = _runs(speech)
+    return [
+        (int(start * frame_len), int(min(end * frame_len, len(samples))))
+        for start, end in zip(starts, ends)
+    ]
+
+
+# Trim leading/trailing silence and shorten long pauses.
+# Returns the trimmed samples and (original_start, original_end, trimmed_start)
+# segment timestamps in seconds, so transcript times can be mapped back.
+def trim_silence(samples, rate, max_pause_ms=MAX_PAUSE_MS):
+    segments = detect_speech(samples, rate)
+    if not segments:
+        return samples[:0], []
+
+    pause = np.zeros(rate * max_pause_ms // 1000, dtype=samples.dtype)
+    pieces = []
+    timestamps = []
+    position = 0
+    previous_end = None
+    for start, end in segments:
+        if previous_end is not None:
+            gap = samples[previous_end:start]
+            gap = gap if len(gap) <= len(pause) else pause
+            pieces.append(gap)
+            position += len(gap)
+        pieces.append(samples[start:end])
+        timestamps.append((start / rate, end / rate, position / rate))
+        position += end - start
+        previous_end = end
+
+    return np.concatenate(pieces), timestamps
+
+
+# Map a time in the trimmed audio back to the original recording
+def to_original_time(t, timestamps):
+    for original_start, original_end, trimmed_start in reversed(timestamps):
+        if t >= trimmed_start:
+            return min(original_start + t - trimmed_start, original_end)
+    return t
+
+
+def read_wav(file):
+    with wave.open(file, "rb") as f:
+        params = f.getparams()
+        if params.sampwidth != 2:
+            raise ValueError("Only 16-bit PCM WAV is supported")
+        samples = np.frombuffer(f.readframes(params.nframes), dtype="<i2")
+    if params.nchannels > 1:
+        samples = samples.reshape(-1, params.nchannels).mean(axis=1).astype("<i2")
+    return samples, params.framerate
+
+
+def write_wav(samples, rate):
+    out = io.BytesIO()
+    with wave.open(out, "wb") as f:
+        f.setnchannels(1)
+        f.setsampwidth(2)
+        f.setframerate(rate)
+        f.writeframes(samples.astype("<i2", copy=False))
+    return out.getvalue()
+
+
+# Silence-trim WAV bytes (or an open WAV file) before upload. Returns (wav_bytes, timestamps).
+def trim_wav_bytes(data, max_pause_ms=MAX_PAUSE_MS):
+    samples, rate = read_wav(data if hasattr(data, "read") else io.BytesIO(data))
+    trimmed, timestamps = trim_silence(samples, rate, max_pause_ms)
+    return write_wav(trimmed, rate), timestamps